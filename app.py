@@ -1,4 +1,5 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, make_response
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, make_response, Response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from werkzeug.security import generate_password_hash, check_password_hash
 import os
 import uuid
@@ -6,64 +7,357 @@ import platform
 import io
 import sys
 import csv
-from datetime import datetime
+import time
+import json
+import base64
+import heapq
+import bisect
+import itertools
+import unicodedata
+import threading
+import re
+import random
+import queue
+import atexit
+import hashlib
+import select
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 import pytz
-
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
+import click
 
 try:
     import psycopg2
-    from psycopg2.extras import RealDictCursor
+    from psycopg2.extras import RealDictCursor, execute_batch, execute_values
+    from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 except ImportError:
     psycopg2 = None
 
 import sqlite3
 
+class JSONFechas(DefaultJSONProvider):
+    # En Postgres las fechas llegan como datetime: se serializan igual que el texto de SQLite
+    @staticmethod
+    def default(o):
+        if isinstance(o, datetime): return o.strftime("%Y-%m-%d %H:%M:%S")
+        return DefaultJSONProvider.default(o)
+
 app = Flask(__name__)
+app.json = JSONFechas(app)
 app.secret_key = os.environ.get('SECRET_KEY', 'clave_maestra_iron_trace_final_v5')
 DB_NAME = "irontrace.db"
 DATABASE_URL = os.environ.get('DATABASE_URL')
 
+# Pool de conexiones (por worker de gunicorn). Por defecto una conexión por hilo (gunicorn.conf.py lee la misma
+# GUNICORN_THREADS): con menos, los hilos que sobran esperan DB_POOL_TIMEOUT y fallan. Con varios workers el total
+# (workers x pool) tiene que caber en max_connections de Postgres: bajar GUNICORN_THREADS o fijar DB_POOL_MAX.
+POOL_MAX = int(os.environ.get('DB_POOL_MAX') or os.environ.get('GUNICORN_THREADS', 32))
+POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 10))      # seg. máximo esperando conexión libre
+POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))    # seg. de vida antes de reciclar
+POOL_PING = int(os.environ.get('DB_POOL_PING', 30))            # seg. inactiva antes de validar con SELECT 1
+SQLITE_BUSY_MS = int(os.environ.get('SQLITE_BUSY_MS', 5000))
+
 def get_chile_time():
     return datetime.now(pytz.timezone('America/Santiago'))
 
 def get_str_now():
     return get_chile_time().strftime("%Y-%m-%d %H:%M:%S")
 
+# --- METRICAS ---
+# Latencia por ruta, consultas SQL por request, consultas lentas y tiempos de conexión, por proceso (cada worker
+# de gunicorn expone las suyas). Solo se miden los requests muestreados (METRICAS_MUESTREO, 0 a 1); fuera de la
+# muestra el costo es un random() por request y un perf_counter() por consulta para el log de lentas.
+METRICAS_MUESTREO = float(os.environ.get('METRICAS_MUESTREO', 1))
+METRICAS_SQL_LENTO_MS = float(os.environ.get('METRICAS_SQL_LENTO_MS', 200))
+METRICAS_TOKEN = os.environ.get('METRICAS_TOKEN')  # para que Prometheus lea /metrics sin sesión
+CUBETAS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+_RE_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_RE_LISTA = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+
+def normalizar_sql(sql):
+    """Misma forma para la misma consulta: literales y parámetros pasan a ?, las listas IN a (...)."""
+    return ' '.join(_RE_LISTA.sub('(...)', _RE_LITERAL.sub('?', sql.replace('%s', '?'))).split())[:300]
+
+class Histograma:
+    __slots__ = ('cuentas', 'suma', 'n')
+    def __init__(self): self.cuentas = [0] * (len(CUBETAS_MS) + 1); self.suma = 0.0; self.n = 0
+
+    def observar(self, ms): self.cuentas[bisect.bisect_left(CUBETAS_MS, ms)] += 1; self.suma += ms; self.n += 1
+
+    def percentil(self, p):
+        # Interpolación lineal dentro de la cubeta, igual que histogram_quantile de Prometheus
+        if not self.n: return None
+        objetivo = p * self.n; acum = 0
+        for i, c in enumerate(self.cuentas):
+            if c and acum + c >= objetivo:
+                if i == len(CUBETAS_MS): return CUBETAS_MS[-1]
+                bajo = CUBETAS_MS[i - 1] if i else 0
+                return bajo + (CUBETAS_MS[i] - bajo) * (objetivo - acum) / c
+            acum += c
+
+class Metricas:
+    def __init__(self):
+        self.lock = threading.Lock(); self.rutas = {}
+        self.sql = Histograma(); self.conexion = Histograma(); self.checkout = Histograma()
+        self.lentas = deque(maxlen=50); self.lentas_por_sql = {}
+
+    def observar_request(self, metodo, ruta, ms, sql_n, sql_ms, error):
+        with self.lock:
+            r = self.rutas.get((metodo, ruta))
+            if r is None: r = self.rutas[(metodo, ruta)] = {'lat': Histograma(), 'sql_n': 0, 'sql_ms': 0.0, 'errores': 0}
+            r['lat'].observar(ms); r['sql_n'] += sql_n; r['sql_ms'] += sql_ms; r['errores'] += error
+
+    def observar(self, histograma, ms):
+        with self.lock: histograma.observar(ms)
+
+    def lenta(self, sql, ms, ruta):
+        norm = normalizar_sql(sql); print(f"SQL lenta {ms:.0f} ms [{ruta}]: {norm}")
+        with self.lock:
+            self.lentas.append({'fecha': get_str_now(), 'ms': round(ms, 1), 'ruta': ruta, 'sql': norm})
+            n, total, maximo = self.lentas_por_sql.get(norm, (0, 0.0, 0.0))
+            self.lentas_por_sql[norm] = (n + 1, total + ms, max(maximo, ms))
+
+    def resumen(self):
+        redondear = lambda v: round(v, 1) if v is not None else None
+        with self.lock:
+            rutas = [{'metodo': m, 'ruta': ruta, 'n': r['lat'].n, 'p50': redondear(r['lat'].percentil(0.5)), 'p95': redondear(r['lat'].percentil(0.95)),
+                      'p99': redondear(r['lat'].percentil(0.99)), 'sql_prom': round(r['sql_n'] / r['lat'].n, 1), 'sql_ms_prom': round(r['sql_ms'] / r['lat'].n, 1),
+                      'errores': r['errores']} for (m, ruta), r in self.rutas.items()]
+            lentas = sorted(({'sql': k, 'n': n, 'prom_ms': round(t / n, 1), 'max_ms': round(mx, 1)} for k, (n, t, mx) in self.lentas_por_sql.items()), key=lambda x: -x['n'] * x['prom_ms'])
+            otros = {nombre: {'n': h.n, 'p50': redondear(h.percentil(0.5)), 'p99': redondear(h.percentil(0.99))} for nombre, h in [('sql', self.sql), ('conexion', self.conexion), ('checkout', self.checkout)]}
+        return {'rutas': sorted(rutas, key=lambda r: -r['n']), 'lentas': lentas[:20], 'muestreo': METRICAS_MUESTREO, 'umbral_lenta_ms': METRICAS_SQL_LENTO_MS, **otros}
+
+    def prometheus(self):
+        lineas = []; esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"')
+        def histograma(nombre, ayuda, series):
+            lineas.extend([f"# HELP {nombre} {ayuda}", f"# TYPE {nombre} histogram"])
+            for etiquetas, h in series:
+                pre = ''.join(f'{k}="{esc(v)}",' for k, v in etiquetas); acum = 0
+                for le, c in zip(CUBETAS_MS + ('+Inf',), h.cuentas):
+                    acum += c; lineas.append(f'{nombre}_bucket{{{pre}le="{le}"}} {acum}')
+                lineas.append(f"{nombre}_sum{{{pre.rstrip(',')}}} {h.suma:.3f}"); lineas.append(f"{nombre}_count{{{pre.rstrip(',')}}} {h.n}")
+        with self.lock:
+            histograma('irontrace_request_ms', 'Latencia por ruta (ms)', [((('metodo', m), ('ruta', r)), v['lat']) for (m, r), v in sorted(self.rutas.items())])
+            for nombre, ayuda, clave in [('irontrace_request_sql_total', 'Consultas SQL por ruta', 'sql_n'), ('irontrace_request_sql_ms_total', 'Tiempo SQL por ruta (ms)', 'sql_ms'), ('irontrace_request_errores_total', 'Requests con excepción por ruta', 'errores')]:
+                lineas.extend([f"# HELP {nombre} {ayuda}", f"# TYPE {nombre} counter"])
+                lineas.extend(f'{nombre}{{metodo="{m}",ruta="{esc(r)}"}} {v[clave]:g}' for (m, r), v in sorted(self.rutas.items()))
+            histograma('irontrace_sql_ms', 'Duración de consultas SQL (ms)', [((), self.sql)])
+            histograma('irontrace_db_conexion_ms', 'Apertura de conexiones nuevas a la base (ms)', [((), self.conexion)])
+            histograma('irontrace_db_checkout_ms', 'Espera para obtener una conexión (ms)', [((), self.checkout)])
+            lineas.extend(["# HELP irontrace_sql_lentas_total Consultas sobre el umbral", "# TYPE irontrace_sql_lentas_total counter", f"irontrace_sql_lentas_total {sum(n for n, _, _ in self.lentas_por_sql.values())}"])
+        return "\n".join(lineas) + "\n"
+
+metricas = Metricas()
+_req = threading.local()
+
+def medir_sql(sql, t0):
+    ms = (time.perf_counter() - t0) * 1000
+    if getattr(_req, 'medir', False):
+        _req.sql_n += 1; _req.sql_ms += ms; metricas.observar(metricas.sql, ms)
+    if ms >= METRICAS_SQL_LENTO_MS: metricas.lenta(sql, ms, getattr(_req, 'ruta', None) or '-')
+
+@app.before_request
+def _medir_inicio():
+    _req.ruta = request.url_rule.rule if request.url_rule else 'sin_ruta'
+    _req.medir = METRICAS_MUESTREO >= 1 or random.random() < METRICAS_MUESTREO
+    if _req.medir: _req.t0 = time.perf_counter(); _req.sql_n = 0; _req.sql_ms = 0.0
+
+@app.teardown_request
+def _medir_fin(exc):
+    # teardown corre cuando termina la respuesta completa (incluido el streaming de exportaciones)
+    if getattr(_req, 'medir', False):
+        metricas.observar_request(request.method, _req.ruta, (time.perf_counter() - _req.t0) * 1000, _req.sql_n, _req.sql_ms, exc is not None)
+    _req.medir = False; _req.ruta = None
+
 def get_db_connection():
+    t0 = time.perf_counter()
+    try: return _abrir_conexion()
+    finally: metricas.observar(metricas.conexion, (time.perf_counter() - t0) * 1000)
+
+def _abrir_conexion():
     if DATABASE_URL:
         if not psycopg2: raise ImportError("Falta psycopg2")
-        conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+        conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor, connect_timeout=POOL_TIMEOUT)
         return conn, 'POSTGRES'
     else:
-        conn = sqlite3.connect(DB_NAME)
+        conn = sqlite3.connect(DB_NAME, timeout=SQLITE_BUSY_MS / 1000)
         conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_MS}")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
         return conn, 'SQLITE'
 
+# --- POOL DE CONEXIONES ---
+# Postgres: pool acotado por proceso (cada worker de gunicorn tiene el suyo).
+# SQLite: una conexión persistente por hilo, en modo WAL.
+class PoolConexiones:
+    def __init__(self, crear, maximo=POOL_MAX, timeout=POOL_TIMEOUT, reciclar=POOL_RECYCLE, ping=POOL_PING):
+        self.crear = crear; self.maximo = maximo; self.timeout = timeout; self.reciclar = reciclar; self.ping = ping
+        self.libres = []; self.creadas = {}; self.en_uso = 0
+        self.cond = threading.Condition()
+        self.stats = {'checkouts': 0, 'esperas': 0, 'espera_ms': 0.0, 'timeouts': 0, 'creadas': 0, 'recicladas': 0, 'descartadas': 0}
+
+    def obtener(self):
+        t0 = time.monotonic(); espero = False; conn = None
+        with self.cond:
+            while True:
+                if self.libres: conn, usada = self.libres.pop(); break
+                if self.en_uso < self.maximo: break
+                espero = True
+                restante = self.timeout - (time.monotonic() - t0)
+                if restante <= 0:
+                    self.stats['timeouts'] += 1
+                    raise TimeoutError(f"Pool agotado ({self.maximo} conexiones en uso)")
+                self.cond.wait(restante)
+            self.en_uso += 1; self.stats['checkouts'] += 1
+            if espero: self.stats['esperas'] += 1; self.stats['espera_ms'] += (time.monotonic() - t0) * 1000
+        try:
+            if conn is not None and not self._sana(conn, usada): conn = None
+            if conn is None:
+                conn = self.crear()
+                with self.cond: self.creadas[id(conn)] = time.monotonic(); self.stats['creadas'] += 1
+            return conn
+        except Exception:
+            with self.cond: self.en_uso -= 1; self.cond.notify()
+            raise
+
+    def _sana(self, conn, usada):
+        ahora = time.monotonic()
+        if conn.closed or ahora - self.creadas.get(id(conn), 0) > self.reciclar:
+            self._cerrar(conn, 'recicladas'); return False
+        if ahora - usada > self.ping:
+            try:
+                cur = conn.cursor(); cur.execute("SELECT 1"); cur.close(); conn.rollback()
+            except Exception:
+                self._cerrar(conn, 'descartadas'); return False
+        return True
+
+    def _cerrar(self, conn, motivo):
+        with self.cond: self.creadas.pop(id(conn), None); self.stats[motivo] += 1
+        try: conn.close()
+        except Exception: pass
+
+    def devolver(self, conn, descartar=False):
+        if not descartar:
+            try:
+                if conn.closed: descartar = True
+                else: conn.rollback()  # no deja transacciones abiertas en el pool
+            except Exception: descartar = True
+        if descartar: self._cerrar(conn, 'descartadas')
+        with self.cond:
+            self.en_uso -= 1
+            if not descartar: self.libres.append((conn, time.monotonic()))
+            self.cond.notify()
+
+    def cerrar_todo(self):
+        with self.cond: libres = self.libres; self.libres = []
+        for conn, _ in libres: self._cerrar(conn, 'descartadas')
+
+    def estado(self):
+        with self.cond:
+            return dict(self.stats, tamano=len(self.creadas), en_uso=self.en_uso, libres=len(self.libres), maximo=self.maximo)
+
+_pool = None; _pool_pid = None; _pool_lock = threading.Lock()
+_sqlite_local = threading.local()
+_sqlite_stats = {'checkouts': 0, 'creadas': 0}
+
+def obtener_pool():
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():  # tras un fork el hijo arma su propio pool
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = PoolConexiones(lambda: get_db_connection()[0]); _pool_pid = os.getpid()
+    return _pool
+
+def _conexion_sqlite():
+    conn = getattr(_sqlite_local, 'conn', None)
+    if conn is None or getattr(_sqlite_local, 'pid', None) != os.getpid():
+        conn = get_db_connection()[0]; _sqlite_local.conn = conn; _sqlite_local.pid = os.getpid()
+        _sqlite_stats['creadas'] += 1
+    _sqlite_stats['checkouts'] += 1
+    return conn
+
+@contextmanager
+def conexion_db():
+    if DATABASE_URL:
+        t0 = time.perf_counter(); pool = obtener_pool(); conn = pool.obtener(); roto = False
+        if getattr(_req, 'medir', False): metricas.observar(metricas.checkout, (time.perf_counter() - t0) * 1000)
+        try: yield conn, 'POSTGRES'
+        except (psycopg2.OperationalError, psycopg2.InterfaceError): roto = True; raise
+        finally: pool.devolver(conn, descartar=roto)
+    else:
+        conn = _conexion_sqlite()
+        try: yield conn, 'SQLITE'
+        finally:
+            if conn.in_transaction: conn.rollback()
+
+def pool_stats():
+    if DATABASE_URL: return dict(obtener_pool().estado(), motor='POSTGRES', pid=os.getpid())
+    return dict(_sqlite_stats, motor='SQLITE', pid=os.getpid(), modo='WAL por hilo')
+
 def ejecutar_sql(sql, params=(), one=False):
-    conn, db_type = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        if db_type == 'SQLITE': sql = sql.replace('%s', '?')
-        cursor.execute(sql, params)
-        if sql.strip().upper().startswith(('SELECT', 'WITH')):
-            rv = cursor.fetchone() if one else cursor.fetchall()
-            if db_type == 'POSTGRES' and rv:
-                rv = dict(rv) if one else [dict(row) for row in rv]
-            return rv
-        else:
+    with conexion_db() as (conn, db_type):
+        cursor = conn.cursor(); t0 = time.perf_counter()
+        try:
+            if db_type == 'SQLITE': sql = sql.replace('%s', '?')
+            cursor.execute(sql, params)
+            if sql.strip().upper().startswith(('SELECT', 'WITH')):
+                rv = cursor.fetchone() if one else cursor.fetchall()
+                if db_type == 'POSTGRES' and rv:
+                    rv = dict(rv) if one else [dict(row) for row in rv]
+                return rv
+            else:
+                conn.commit()
+                return cursor.lastrowid
+        except Exception as e:
+            conn.rollback()
+            print(f"SQL Error: {e}")
+            raise e
+        finally:
+            medir_sql(sql, t0); cursor.close()
+
+# --- TRANSACCIONES (varias sentencias, una conexión, un commit) ---
+@contextmanager
+def transaccion():
+    with conexion_db() as (conn, db_type):
+        cur = conn.cursor()
+        try:
+            if db_type == 'SQLITE' and not conn.in_transaction: cur.execute("BEGIN IMMEDIATE")  # toma el lock de escritura de entrada
+            yield cur, db_type
             conn.commit()
-            return cursor.lastrowid
-    except Exception as e:
-        conn.rollback()
-        print(f"SQL Error: {e}")
-        raise e
-    finally:
-        conn.close()
+        except Exception:
+            conn.rollback(); raise
+        finally:
+            cur.close()
+
+def sql_tx(cur, db_type, sql, params=()):
+    t0 = time.perf_counter()
+    cur.execute(sql.replace('%s', '?') if db_type == 'SQLITE' else sql, params)
+    medir_sql(sql, t0)
+    return cur
+
+def sql_lote(cur, db_type, sql, filas):
+    if not filas: return
+    t0 = time.perf_counter()
+    if db_type == 'SQLITE': cur.executemany(sql.replace('%s', '?'), filas)
+    else: execute_batch(cur, sql, filas, page_size=200)
+    medir_sql(sql, t0)
+
+def sql_insertar_ids(cur, db_type, sql, filas):
+    """INSERT ... VALUES %s que devuelve los ids generados, en el mismo orden de las filas."""
+    if not filas: return []
+    if db_type == 'POSTGRES':
+        return [r['id'] for r in execute_values(cur, sql + " RETURNING id", filas, page_size=len(filas), fetch=True)]
+    sql = sql.replace('%s', '(' + ','.join(['?'] * len(filas[0])) + ')'); ids = []
+    for f in filas: cur.execute(sql, f); ids.append(cur.lastrowid)
+    return ids
 
 def init_db():
+    """Crea el esquema y aplica migraciones pendientes. Corre una vez por despliegue (flask --app app init-db o el
+    hook on_starting de gunicorn.conf.py), no en cada worker: con el esquema al día solo lee schema_version."""
     conn, db_type = get_db_connection()
+    if version_actual(conn) >= MIGRACIONES[-1][0]: conn.close(); return False
     c = conn.cursor()
     t_text = "TEXT" if db_type == 'SQLITE' else "VARCHAR(255)"
     
@@ -91,9 +385,733 @@ def init_db():
             c.execute(f"INSERT INTO usuarios (username, password, rol) VALUES ('admin', 'admin123', 'admin')")
             conn.commit()
     except: pass
+    migrar_db(conn, db_type)
     conn.close()
+    return True
+
+# --- RESUMENES (contadores del dashboard y reportes) ---
+# Se actualizan en la misma transacción que la salida, devolución, baja o ingreso que los mueve, así el
+# dashboard lee un par de filas en vez de recorrer prestamos. `flask --app app resumen verificar|reconstruir`
+# los compara o recalcula contra las filas crudas.
+CONTADORES = ('activos_qty', 'activos_valor', 'terreno_herramientas', 'bodega_herramientas')
+
+def sql_dia(db_type, col):
+    return f"to_char({col}, 'YYYY-MM-DD')" if db_type == 'POSTGRES' else f"substr({col}, 1, 10)"
+
+def aplicar_resumen(cur, db_type, contadores=None, diario=None):
+    """contadores: {clave: delta}; diario: {dia: (valor_insumos, cantidad_insumos)}."""
+    sql_lote(cur, db_type, "UPDATE resumen_contadores SET valor = valor + %s WHERE clave=%s", [(d, k) for k, d in sorted((contadores or {}).items()) if d])
+    sql_lote(cur, db_type, "INSERT INTO resumen_diario (dia, insumos_valor, insumos_qty) VALUES (%s,%s,%s) ON CONFLICT (dia) DO UPDATE SET insumos_valor = resumen_diario.insumos_valor + excluded.insumos_valor, insumos_qty = resumen_diario.insumos_qty + excluded.insumos_qty",
+             [(dia, v, q) for dia, (v, q) in sorted((diario or {}).items())])
+
+def calcular_resumen(cur, db_type, origen='movimientos'):
+    # Los activos viven siempre en prestamos; el consumo diario suma también lo archivado (vista movimientos)
+    uno = lambda sql: sql_tx(cur, db_type, sql).fetchone()
+    activos = uno("SELECT COUNT(*) AS qty, COALESCE(SUM(precio), 0) AS valor FROM prestamos WHERE estado='ACTIVO'")
+    contadores = {
+        'activos_qty': activos['qty'], 'activos_valor': activos['valor'],
+        'terreno_herramientas': uno("SELECT COUNT(*) AS t FROM prestamos WHERE estado='ACTIVO' AND tipo_item='HERRAMIENTA'")['t'],
+        'bodega_herramientas': uno("SELECT COALESCE(SUM(stock), 0) AS t FROM productos WHERE tipo='HERRAMIENTA'")['t'],
+    }
+    dia = sql_dia(db_type, 'fecha_salida')
+    diario = {r['dia']: (r['valor'] or 0, r['qty'] or 0) for r in sql_tx(cur, db_type, f"SELECT {dia} AS dia, SUM(cantidad * precio) AS valor, SUM(cantidad) AS qty FROM {origen} WHERE tipo_item='INSUMO' GROUP BY {dia}").fetchall()}
+    return contadores, diario
+
+def _escribir_resumen(cur, db_type, origen='movimientos'):
+    if db_type == 'POSTGRES': cur.execute("LOCK TABLE prestamos, productos IN SHARE MODE")  # nadie mueve stock ni archiva mientras se recalcula
+    contadores, diario = calcular_resumen(cur, db_type, origen)
+    cur.execute("DELETE FROM resumen_contadores"); cur.execute("DELETE FROM resumen_diario")
+    sql_lote(cur, db_type, "INSERT INTO resumen_contadores (clave, valor) VALUES (%s,%s)", sorted(contadores.items()))
+    sql_lote(cur, db_type, "INSERT INTO resumen_diario (dia, insumos_valor, insumos_qty) VALUES (%s,%s,%s)", [(d, v, q) for d, (v, q) in sorted(diario.items())])
+    return contadores, diario
+
+def reconstruir_resumen():
+    with transaccion() as (cur, db):
+        # Las series se vuelven a cerrar día por día en la próxima consulta de reportes
+        cur.execute("DELETE FROM resumen_series"); sql_tx(cur, db, "UPDATE resumen_series_cierre SET hasta=%s", (SERIES_INICIO,))
+        return _escribir_resumen(cur, db)
+
+# Series de consumo por día, tipo de ítem, faena y sección. Los días ya terminados no cambian: se agregan una vez
+# en resumen_series y resumen_series_cierre guarda hasta qué día (excluido) están cerrados. Solo el día en curso
+# se calcula contra movimientos en cada consulta.
+SERIES_INICIO = '1900-01-01'
+
+def cerrar_series():
+    """Agrega los días terminados que falten. Devuelve el corte: resumen_series cubre los días anteriores a él."""
+    hoy = get_chile_time().strftime("%Y-%m-%d")
+    corte = ejecutar_sql("SELECT hasta FROM resumen_series_cierre WHERE id=1", one=True)['hasta']
+    if corte >= hoy: return corte
+    with transaccion() as (cur, db):
+        corte = sql_tx(cur, db, "SELECT hasta FROM resumen_series_cierre WHERE id=1" + (" FOR UPDATE" if db == 'POSTGRES' else "")).fetchone()['hasta']
+        if corte >= hoy: return corte  # otro worker cerró mientras esperábamos el lock
+        dia = sql_dia(db, 'p.fecha_salida')
+        sql_tx(cur, db, f"""INSERT INTO resumen_series (dia, tipo_item, faena, seccion, valor, qty, movimientos)
+            SELECT {dia}, p.tipo_item, COALESCE(t.faena, ''), COALESCE(t.seccion, ''), SUM(p.cantidad * COALESCE(p.precio, 0)), SUM(p.cantidad), COUNT(*)
+            FROM movimientos p LEFT JOIN trabajadores t ON t.rut = p.worker_id
+            WHERE p.fecha_salida >= %s AND p.fecha_salida < %s GROUP BY {dia}, p.tipo_item, COALESCE(t.faena, ''), COALESCE(t.seccion, '')""", (corte, hoy))
+        sql_tx(cur, db, "UPDATE resumen_series_cierre SET hasta=%s WHERE id=1", (hoy,))
+    return hoy
+
+def sumar_movimientos_cerrados(cur, db_type, filas):
+    """filas: [(fecha_salida, tipo_item, worker_id)] de movimientos nuevos con fecha de salida pasada (devolución
+    parcial: la fila se parte en dos y conserva la fecha). Si ese día ya está cerrado en resumen_series se suma
+    ahí el movimiento; cantidad y valor no cambian, solo se reparten entre las dos filas."""
+    if not filas: return
+    # FOR SHARE: espera a un cerrar_series en curso, o lo hace esperar, así el movimiento se cuenta una sola vez
+    corte = sql_tx(cur, db_type, "SELECT hasta FROM resumen_series_cierre WHERE id=1" + (" FOR SHARE" if db_type == 'POSTGRES' else "")).fetchone()['hasta']
+    cerradas = [(str(f)[:10], tipo, w) for f, tipo, w in filas if str(f)[:10] < corte]
+    if not cerradas: return
+    ruts = sorted({w for _, _, w in cerradas})
+    trab = {r['rut']: (r['faena'] or '', r['seccion'] or '') for r in sql_tx(cur, db_type, f"SELECT rut, faena, seccion FROM trabajadores WHERE rut IN ({','.join(['%s'] * len(ruts))})", tuple(ruts)).fetchall()}
+    sql_lote(cur, db_type, """INSERT INTO resumen_series (dia, tipo_item, faena, seccion, valor, qty, movimientos) VALUES (%s,%s,%s,%s,0,0,1)
+        ON CONFLICT (dia, tipo_item, faena, seccion) DO UPDATE SET movimientos = resumen_series.movimientos + 1""",
+             [(dia, tipo) + trab.get(w, ('', '')) for dia, tipo, w in cerradas])
+
+def verificar_resumen():
+    """Lista de diferencias (clave, guardado, real); vacía si los resúmenes cuadran."""
+    with transaccion() as (cur, db):
+        contadores, diario = calcular_resumen(cur, db)
+        guardados = {r['clave']: r['valor'] for r in sql_tx(cur, db, "SELECT clave, valor FROM resumen_contadores").fetchall()}
+        dias = {r['dia']: (r['insumos_valor'], r['insumos_qty']) for r in sql_tx(cur, db, "SELECT * FROM resumen_diario").fetchall()}
+    difs = [(k, guardados.get(k), v) for k, v in contadores.items() if guardados.get(k) != v]
+    difs += [(f"dia {d}", dias.get(d), diario.get(d)) for d in sorted(set(dias) | set(diario)) if dias.get(d, (0, 0)) != diario.get(d, (0, 0))]
+    return difs
+
+@app.cli.command('resumen')
+@click.argument('accion', type=click.Choice(['verificar', 'reconstruir']))
+def cli_resumen(accion):
+    if accion == 'reconstruir':
+        contadores, diario = reconstruir_resumen(); print(f"Resúmenes reconstruidos: {contadores}, {len(diario)} días")
+        return
+    difs = verificar_resumen()
+    for clave, guardado, real in difs: print(f"DIFERENCIA {clave}: guardado={guardado} real={real}")
+    print("Resúmenes OK" if not difs else f"{len(difs)} diferencias (corregir con: flask --app app resumen reconstruir)")
+    if difs: sys.exit(1)
+
+# --- ARCHIVO (movimientos cerrados a prestamos_historico) ---
+# prestamos solo crece, pero lo caliente (dashboard, devoluciones, préstamos por trabajador) mira estado='ACTIVO'.
+# Los movimientos cerrados (DEVUELTO, CONSUMIDO) con salida anterior a ARCHIVO_DIAS pasan a prestamos_historico
+# con el mismo id. Nunca vuelven a cambiar, así que moverlos no choca con salidas ni devoluciones; cada lote es una
+# transacción corta y entre lotes se suelta el lock de escritura. Reportes, exportaciones, series y tickets leen la
+# vista movimientos (prestamos UNION ALL prestamos_historico, ya unida a productos). Correr por cron:
+# `flask --app app archivar`.
+ARCHIVO_DIAS = int(os.environ.get('ARCHIVO_DIAS', 180))
+ARCHIVO_LOTE = int(os.environ.get('ARCHIVO_LOTE', 2000))
+ARCHIVO_PAUSA = float(os.environ.get('ARCHIVO_PAUSA', 0.2))
+COLUMNAS_PRESTAMO = "id, transaction_id, worker_id, tool_id, tipo_item, cantidad, fecha_salida, fecha_regreso, estado, precio"
+
+def archivar_prestamos(dias=ARCHIVO_DIAS, lote=ARCHIVO_LOTE, pausa=ARCHIVO_PAUSA, maximo=None):
+    """Mueve de a `lote` filas con `pausa` segundos entre lotes. Devuelve cuántos movimientos archivó."""
+    corte = (get_chile_time() - timedelta(days=dias)).strftime("%Y-%m-%d"); movidas = 0; ultimo = None
+    while maximo is None or movidas < maximo:
+        n = lote if maximo is None else min(lote, maximo - movidas)
+        with transaccion() as (cur, db):
+            # Keyset sobre (fecha_salida, id): no se vuelven a recorrer los ACTIVO viejos que quedan atrás
+            desde = " AND (fecha_salida, id) > (%s, %s)" if ultimo else ""
+            filas = sql_tx(cur, db, f"SELECT id, fecha_salida FROM prestamos WHERE fecha_salida < %s AND estado <> 'ACTIVO'{desde} ORDER BY fecha_salida, id LIMIT {n}",
+                           (corte,) + (ultimo or ())).fetchall()
+            if filas:
+                ids = tuple(r['id'] for r in filas); holder = ','.join(['%s'] * len(ids))
+                sql_tx(cur, db, f"INSERT INTO prestamos_historico ({COLUMNAS_PRESTAMO}) SELECT {COLUMNAS_PRESTAMO} FROM prestamos WHERE id IN ({holder})", ids)
+                sql_tx(cur, db, f"DELETE FROM prestamos WHERE id IN ({holder})", ids)
+        if not filas: break
+        movidas += len(filas); ultimo = (filas[-1]['fecha_salida'], filas[-1]['id'])
+        if len(filas) < n: break
+        time.sleep(pausa)
+    return movidas
+
+@app.cli.command('archivar')
+@click.option('--dias', default=ARCHIVO_DIAS, show_default=True, help="antigüedad mínima de la salida")
+@click.option('--lote', default=ARCHIVO_LOTE, show_default=True, help="filas por transacción")
+@click.option('--pausa', default=ARCHIVO_PAUSA, show_default=True, help="segundos entre lotes")
+@click.option('--maximo', type=int, default=None, help="tope de filas en esta corrida")
+def cli_archivar(dias, lote, pausa, maximo):
+    t0 = time.time(); n = archivar_prestamos(dias, lote, pausa, maximo)
+    print(f"{n:,} movimientos archivados en {time.time() - t0:.1f} s")
+
+# --- MIGRACIONES DE ESQUEMA ---
+# Cada migración corre una sola vez por base y queda registrada en schema_version.
+# Para cambiar el esquema se agrega una tupla al final de MIGRACIONES; nunca se editan las ya publicadas.
+def _mig_fechas_timestamp(c, db_type):
+    # SQLite no tiene tipo fecha: el texto 'YYYY-MM-DD HH:MM:SS' ya ordena bien y usa índices con rangos
+    if db_type != 'POSTGRES': return
+    for tabla, col in [('prestamos', 'fecha_salida'), ('prestamos', 'fecha_regreso'), ('facturas', 'fecha'), ('bajas', 'fecha'), ('login_logs', 'fecha')]:
+        c.execute(f"ALTER TABLE {tabla} ALTER COLUMN {col} TYPE TIMESTAMP USING NULLIF({col}, '')::timestamp")
+
+def _mig_indices(c, db_type):
+    for q in [
+        "CREATE INDEX IF NOT EXISTS idx_prestamos_tx ON prestamos (transaction_id)",
+        "CREATE INDEX IF NOT EXISTS idx_prestamos_worker_estado ON prestamos (worker_id, estado, tipo_item)",
+        "CREATE INDEX IF NOT EXISTS idx_prestamos_fecha ON prestamos (fecha_salida)",
+        "CREATE INDEX IF NOT EXISTS idx_prestamos_activos ON prestamos (fecha_salida) WHERE estado='ACTIVO'",
+        "CREATE INDEX IF NOT EXISTS idx_prestamos_insumos ON prestamos (fecha_salida) WHERE tipo_item='INSUMO'",
+        "CREATE INDEX IF NOT EXISTS idx_productos_tipo_stock ON productos (tipo, stock)",
+        "CREATE INDEX IF NOT EXISTS idx_trabajadores_nombre ON trabajadores (nombre)",
+    ]: c.execute(q)
+
+def _mig_trigramas(c, db_type):
+    # Opcional: solo para BUSQUEDA_MOTOR=pg_trgm. Si el usuario no puede crear la extensión se sigue sin ella.
+    if db_type != 'POSTGRES': return
+    c.execute("SAVEPOINT trgm")
+    try: c.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except Exception as e: c.execute("ROLLBACK TO SAVEPOINT trgm"); print(f"pg_trgm no disponible: {e}"); return
+    c.execute("CREATE INDEX IF NOT EXISTS idx_productos_nombre_trgm ON productos USING gin (lower(nombre) gin_trgm_ops)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_trabajadores_trgm ON trabajadores USING gin ((rut || ' ' || upper(nombre)) gin_trgm_ops)")
+
+def _mig_cache_versiones(c, db_type):
+    t_text = "TEXT" if db_type == 'SQLITE' else "VARCHAR(255)"
+    c.execute(f"CREATE TABLE IF NOT EXISTS cache_versiones (clave {t_text} PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)")
+    for clave in ('config', 'productos', 'trabajadores'):
+        sql_tx(c, db_type, "INSERT INTO cache_versiones (clave, version) VALUES (%s, 0)", (clave,))
+
+def _mig_resumenes(c, db_type):
+    t_text = "TEXT" if db_type == 'SQLITE' else "VARCHAR(255)"
+    # El valor de cada movimiento queda con el precio del momento de la salida
+    c.execute("ALTER TABLE prestamos ADD COLUMN precio INTEGER")
+    c.execute("UPDATE prestamos SET precio = (SELECT precio FROM productos WHERE productos.id = prestamos.tool_id)")
+    c.execute(f"CREATE TABLE IF NOT EXISTS resumen_contadores (clave {t_text} PRIMARY KEY, valor BIGINT NOT NULL DEFAULT 0)")
+    c.execute(f"CREATE TABLE IF NOT EXISTS resumen_diario (dia {t_text} PRIMARY KEY, insumos_valor BIGINT NOT NULL DEFAULT 0, insumos_qty BIGINT NOT NULL DEFAULT 0)")
+    _escribir_resumen(c, db_type, 'prestamos')  # la vista movimientos llega en la migración 10
+
+def _mig_indices_paginacion(c, db_type):
+    # (orden, clave única): el keyset recorre el índice desde el último valor visto. Reemplazan a los de una columna.
+    for q in [
+        "CREATE INDEX IF NOT EXISTS idx_trabajadores_nombre_rut ON trabajadores (nombre, rut)",
+        "DROP INDEX IF EXISTS idx_trabajadores_nombre",
+        "CREATE INDEX IF NOT EXISTS idx_productos_nombre_id ON productos (nombre, id)",
+        "CREATE INDEX IF NOT EXISTS idx_productos_stock_id ON productos (stock, id)",
+        "CREATE INDEX IF NOT EXISTS idx_prestamos_fecha_id ON prestamos (fecha_salida, id)",
+        "DROP INDEX IF EXISTS idx_prestamos_fecha",
+    ]: c.execute(q)
+
+def _mig_series(c, db_type):
+    t_text = "TEXT" if db_type == 'SQLITE' else "VARCHAR(255)"
+    c.execute(f"""CREATE TABLE IF NOT EXISTS resumen_series (dia {t_text} NOT NULL, tipo_item {t_text} NOT NULL, faena {t_text} NOT NULL, seccion {t_text} NOT NULL,
+                 valor BIGINT NOT NULL DEFAULT 0, qty BIGINT NOT NULL DEFAULT 0, movimientos BIGINT NOT NULL DEFAULT 0, PRIMARY KEY (dia, tipo_item, faena, seccion))""")
+    c.execute(f"CREATE TABLE IF NOT EXISTS resumen_series_cierre (id INTEGER PRIMARY KEY, hasta {t_text} NOT NULL)")
+    sql_tx(c, db_type, "INSERT INTO resumen_series_cierre (id, hasta) VALUES (1, %s)", (SERIES_INICIO,))
+
+def _mig_auditoria(c, db_type):
+    # Misma tabla que define seed_data.py; en Postgres fecha es TIMESTAMP como el resto tras la migración 1
+    if db_type == 'POSTGRES': c.execute("CREATE TABLE IF NOT EXISTS auditoria (id SERIAL PRIMARY KEY, fecha TIMESTAMP, usuario VARCHAR(255), accion VARCHAR(255), detalle TEXT)")
+    else: c.execute("CREATE TABLE IF NOT EXISTS auditoria (id INTEGER PRIMARY KEY AUTOINCREMENT, fecha TEXT, usuario TEXT, accion TEXT, detalle TEXT)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_auditoria_fecha ON auditoria (fecha)")
+
+def _mig_tickets_invalidados(c, db_type):
+    if db_type == 'POSTGRES': c.execute("CREATE TABLE IF NOT EXISTS tickets_invalidados (id SERIAL PRIMARY KEY, clave VARCHAR(255), fecha TIMESTAMP)")
+    else: c.execute("CREATE TABLE IF NOT EXISTS tickets_invalidados (id INTEGER PRIMARY KEY AUTOINCREMENT, clave TEXT, fecha TEXT)")
+
+def _mig_historico(c, db_type):
+    # Mismas columnas y tipos que prestamos tras las migraciones 1 y 5; el id se conserva al archivar
+    t_text = "TEXT" if db_type == 'SQLITE' else "VARCHAR(255)"; t_fecha = "TIMESTAMP" if db_type == 'POSTGRES' else t_text
+    c.execute(f"""CREATE TABLE IF NOT EXISTS prestamos_historico (id INTEGER PRIMARY KEY, transaction_id {t_text}, worker_id {t_text}, tool_id {t_text},
+                 tipo_item {t_text}, cantidad INTEGER, fecha_salida {t_fecha}, fecha_regreso {t_fecha}, estado {t_text}, precio INTEGER)""")
+    for q in [
+        "CREATE INDEX IF NOT EXISTS idx_historico_tx ON prestamos_historico (transaction_id)",
+        "CREATE INDEX IF NOT EXISTS idx_historico_fecha_id ON prestamos_historico (fecha_salida, id)",
+        "CREATE INDEX IF NOT EXISTS idx_historico_worker ON prestamos_historico (worker_id, fecha_salida)",
+    ]: c.execute(q)
+    # La unión a productos va dentro de cada rama: así ORDER BY fecha_salida, id LIMIT n se resuelve mezclando
+    # los dos índices (fecha_salida, id) en vez de materializar la unión completa
+    ramas = [f"SELECT {', '.join('p.' + x for x in COLUMNAS_PRESTAMO.split(', '))}, prod.nombre FROM {t} p LEFT JOIN productos prod ON p.tool_id = prod.id"
+             for t in ('prestamos', 'prestamos_historico')]
+    c.execute("CREATE VIEW movimientos AS " + " UNION ALL ".join(ramas))
+
+def _mig_eventos(c, db_type):
+    # Solo SQLite: en Postgres los eventos van por NOTIFY
+    if db_type == 'POSTGRES': return
+    c.execute("CREATE TABLE IF NOT EXISTS eventos (id INTEGER PRIMARY KEY AUTOINCREMENT, fecha TEXT, datos TEXT)")
+
+def _mig_sync(c, db_type):
+    t_text = "TEXT" if db_type == 'SQLITE' else "VARCHAR(255)"; t_fecha = "TIMESTAMP" if db_type == 'POSTGRES' else t_text
+    c.execute(f"CREATE TABLE IF NOT EXISTS sync_operaciones (clave {t_text} PRIMARY KEY, tipo {t_text}, usuario {t_text}, fecha {t_fecha}, resultado TEXT)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sync_fecha ON sync_operaciones (fecha)")
+
+def _mig_sync_por_usuario(c, db_type):
+    # Las claves las genera cada terminal: con la clave sola como llave, la de otro usuario devolvería su resultado
+    c.execute("DELETE FROM sync_operaciones WHERE usuario IS NULL")
+    if db_type == 'POSTGRES':
+        c.execute("ALTER TABLE sync_operaciones DROP CONSTRAINT sync_operaciones_pkey, ALTER COLUMN usuario SET NOT NULL, ADD PRIMARY KEY (usuario, clave)")
+        return
+    # SQLite no cambia la llave de una tabla existente: se rehace
+    c.execute("ALTER TABLE sync_operaciones RENAME TO sync_operaciones_v12"); c.execute("DROP INDEX IF EXISTS idx_sync_fecha")
+    c.execute("CREATE TABLE sync_operaciones (clave TEXT NOT NULL, tipo TEXT, usuario TEXT NOT NULL, fecha TEXT, resultado TEXT, PRIMARY KEY (usuario, clave))")
+    c.execute("INSERT INTO sync_operaciones SELECT clave, tipo, usuario, fecha, resultado FROM sync_operaciones_v12")
+    c.execute("DROP TABLE sync_operaciones_v12"); c.execute("CREATE INDEX IF NOT EXISTS idx_sync_fecha ON sync_operaciones (fecha)")
+
+MIGRACIONES = [
+    (1, 'Fechas de texto a TIMESTAMP', _mig_fechas_timestamp),
+    (2, 'Índices de prestamos, productos y trabajadores', _mig_indices),
+    (3, 'Índices de trigramas para búsqueda (pg_trgm)', _mig_trigramas),
+    (4, 'Versiones para invalidar caches entre workers', _mig_cache_versiones),
+    (5, 'Precio por movimiento y resúmenes del dashboard', _mig_resumenes),
+    (6, 'Índices compuestos para paginación por cursor', _mig_indices_paginacion),
+    (7, 'Series de consumo por día, faena y sección', _mig_series),
+    (8, 'Tabla de auditoría', _mig_auditoria),
+    (9, 'Invalidación de tickets cacheados entre workers', _mig_tickets_invalidados),
+    (10, 'Histórico de movimientos cerrados y vista movimientos', _mig_historico),
+    (11, 'Eventos en vivo del dashboard (SQLite)', _mig_eventos),
+    (12, 'Claves de operaciones sincronizadas desde terminales', _mig_sync),
+    (13, 'Claves de sincronización por usuario', _mig_sync_por_usuario),
+]
+
+def version_esquema(c):
+    c.execute("SELECT MAX(version) AS v FROM schema_version")
+    return c.fetchone()['v'] or 0
+
+def version_actual(conn):
+    # 0 si la base está vacía (todavía no existe schema_version)
+    c = conn.cursor()
+    try: return version_esquema(c)
+    except Exception: conn.rollback(); return 0
+    finally: c.close()
+
+def migrar_db(conn, db_type):
+    c = conn.cursor(); t_text = "TEXT" if db_type == 'SQLITE' else "VARCHAR(255)"
+    c.execute(f"CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, descripcion {t_text}, fecha {t_text})"); conn.commit()
+    if version_esquema(c) >= MIGRACIONES[-1][0]: conn.rollback(); return
+    for version, descripcion, aplicar in MIGRACIONES:
+        try:
+            # Varios workers pueden arrancar a la vez: el lock asegura que solo uno aplique cada versión
+            if db_type == 'SQLITE': c.execute("BEGIN IMMEDIATE")
+            else: c.execute("SELECT pg_advisory_xact_lock(7431)")
+            if version_esquema(c) >= version: conn.rollback(); continue
+            aplicar(c, db_type)
+            sql_tx(c, db_type, "INSERT INTO schema_version (version, descripcion, fecha) VALUES (%s,%s,%s)", (version, descripcion, get_str_now()))
+            conn.commit(); print(f"Migración {version} aplicada: {descripcion}")
+        except Exception as e:
+            conn.rollback(); print(f"Migración {version} falló: {e}"); raise
+
+@app.cli.command('init-db')
+def cli_init_db():
+    t0 = time.perf_counter(); aplicado = init_db()
+    print(f"{'Esquema creado/migrado' if aplicado else 'Esquema al día'} (versión {MIGRACIONES[-1][0]}) en {(time.perf_counter() - t0) * 1000:.0f} ms")
+
+# Red de seguridad si el despliegue no corrió init-db: el primer request de cada proceso compara la versión
+# (una consulta) y solo si la base está atrasada aplica las migraciones, bajo el mismo lock de migrar_db.
+_esquema_pid = None; _esquema_lock = threading.Lock()
+
+@app.before_request
+def asegurar_esquema():
+    global _esquema_pid
+    if _esquema_pid == os.getpid(): return
+    with _esquema_lock:
+        if _esquema_pid == os.getpid(): return
+        with conexion_db() as (conn, db_type): atrasada = version_actual(conn) < MIGRACIONES[-1][0]
+        if atrasada: print("Esquema atrasado: aplicando migraciones (correr 'flask --app app init-db' en el despliegue)"); init_db()
+        _esquema_pid = os.getpid()
+
+# --- CACHE DE DATOS DE REFERENCIA ---
+# config, catálogo de productos (sin stock) y nómina de trabajadores se guardan por worker. Cada escritura
+# sube la versión de su clave en cache_versiones; los demás workers leen esa tabla (una fila por clave) a lo
+# más cada CACHE_CHEQUEO segundos y descartan lo que cambió.
+CACHE_CHEQUEO = float(os.environ.get('CACHE_CHEQUEO', 2))
+
+class CacheReferencia:
+    def __init__(self, chequeo=CACHE_CHEQUEO):
+        self.chequeo = chequeo; self.chequeado = 0
+        self.lock = threading.Lock(); self.valores = {}; self.versiones = {}; self.oyentes = {}; self.generaciones = Counter()
+        self.stats = {'aciertos': 0, 'cargas': 0, 'chequeos': 0, 'invalidaciones': 0}
+
+    def suscribir(self, clave, fn):
+        """fn() corre cuando otro worker cambia la clave. Solo se entera dentro de sincronizar(): quien se suscribe
+        sin leer por obtener/firma tiene que llamarlo él mismo antes de usar lo suyo."""
+        self.oyentes.setdefault(clave, []).append(fn)
+
+    def sincronizar(self):
+        """Lee cache_versiones (a lo más cada `chequeo` segundos), descarta lo que cambió y avisa a los suscriptores."""
+        if time.monotonic() - self.chequeado < self.chequeo: return
+        filas = ejecutar_sql("SELECT clave, version FROM cache_versiones"); cambiadas = []
+        with self.lock:
+            self.chequeado = time.monotonic(); self.stats['chequeos'] += 1
+            for r in filas:
+                anterior = self.versiones.get(r['clave']); self.versiones[r['clave']] = r['version']
+                if anterior is not None and anterior != r['version']:
+                    self.valores.pop(r['clave'], None); self.generaciones[r['clave']] += 1
+                    self.stats['invalidaciones'] += 1; cambiadas.append(r['clave'])
+        for clave in cambiadas:
+            for fn in self.oyentes.get(clave, []): fn()
+
+    def obtener(self, clave, cargar):
+        self.sincronizar()
+        with self.lock:
+            if clave in self.valores: self.stats['aciertos'] += 1; return self.valores[clave]
+            generacion = self.generaciones[clave]
+        valor = cargar()
+        with self.lock:
+            self.stats['cargas'] += 1
+            # Si la clave se invalidó mientras se cargaba, lo leído puede ser anterior: se devuelve pero no se guarda
+            if generacion == self.generaciones[clave]: self.valores[clave] = valor
+        return valor
+
+    def tocar(self, clave):
+        """Llamar después de escribir: sube la versión para el resto de los workers y descarta la copia local."""
+        with transaccion() as (cur, db):
+            sql_tx(cur, db, "UPDATE cache_versiones SET version = version + 1 WHERE clave=%s", (clave,))
+            r = sql_tx(cur, db, "SELECT version FROM cache_versiones WHERE clave=%s", (clave,)).fetchone()
+        with self.lock:
+            self.valores.pop(clave, None); self.generaciones[clave] += 1; self.stats['invalidaciones'] += 1
+            if r: self.versiones[clave] = r['version']
+
+    def firma(self, claves):
+        """Versiones actuales de esas claves: sirve para saber si algo derivado de ellas quedó viejo."""
+        self.sincronizar()
+        with self.lock: return tuple(self.versiones.get(c) for c in claves)
+
+    def estado(self):
+        with self.lock: return dict(self.stats, claves=sorted(self.valores), versiones=dict(self.versiones))
+
+cache_ref = CacheReferencia()
+
+def obtener_config():
+    return cache_ref.obtener('config', lambda: {r['clave']: r['valor'] for r in ejecutar_sql("SELECT * FROM config") or []})
+
+def catalogo_productos():
+    return cache_ref.obtener('productos', lambda: {r['id']: dict(r) for r in ejecutar_sql("SELECT id, nombre, precio, tipo FROM productos")})
+
+def nomina_trabajadores():
+    return cache_ref.obtener('trabajadores', lambda: {r['rut']: dict(r) for r in ejecutar_sql("SELECT * FROM trabajadores")})
+
+# --- BUSCADOR (autocompletado del operador) ---
+# Índice en memoria por worker: listas ordenadas de frases y palabras para prefijos y trigramas para
+# subcadenas. Texto sin tildes ni mayúsculas. Las escrituras locales lo actualizan en el acto; las de otros
+# workers llegan por cache_ref y disparan una reconstrucción en segundo plano (BUSQUEDA_TTL como respaldo).
+BUSQUEDA_MOTOR = os.environ.get('BUSQUEDA_MOTOR', 'memoria')  # 'memoria' o 'pg_trgm'
+BUSQUEDA_TTL = int(os.environ.get('BUSQUEDA_TTL', 900))
+
+def normalizar(texto):
+    t = unicodedata.normalize('NFKD', str(texto or '')).encode('ascii', 'ignore').decode()
+    return ' '.join(t.upper().replace('.', '').split())
+
+def trigramas(palabra):
+    return {palabra[i:i+3] for i in range(len(palabra) - 2)}
+
+def _con_prefijo(lista, prefijo):
+    i = bisect.bisect_left(lista, (prefijo,))
+    while i < len(lista) and lista[i][0].startswith(prefijo): yield lista[i][1]; i += 1
+
+class IndiceBusqueda:
+    def __init__(self, nombre, cargar):
+        self.nombre = nombre; self.cargar = cargar  # cargar() -> [(clave, texto, activo), ...]
+        self.lock = threading.Lock(); self.cargado_en = None; self.recargando = False; self.vencido = False
+        self.claves = {}; self.docs = []; self.frases = []; self.palabras = []; self.gramas = {}
+
+    def _agregar(self, clave, texto, activo, ordenar=True):
+        i = len(self.docs); texto = normalizar(texto)
+        self.claves[clave] = i; self.docs.append((clave, texto, activo))
+        entradas = [(sys.intern(p), i) for p in texto.split()]
+        if ordenar:
+            bisect.insort(self.frases, (texto, i))
+            for e in entradas: bisect.insort(self.palabras, e)
+        else: self.frases.append((texto, i)); self.palabras.extend(entradas)
+        for palabra, _ in entradas:
+            for g in trigramas(palabra): self.gramas.setdefault(g, set()).add(i)
+
+    def _quitar(self, clave):
+        i = self.claves.pop(clave, None)
+        if i is None: return
+        texto = self.docs[i][1]; self.docs[i] = None
+        for lista, clave_orden in [(self.frases, texto)] + [(self.palabras, p) for p in texto.split()]:
+            j = bisect.bisect_left(lista, (clave_orden, i))
+            if j < len(lista) and lista[j] == (clave_orden, i): del lista[j]
+        for palabra in texto.split():
+            for g in trigramas(palabra): self.gramas[g].discard(i)
+
+    def reconstruir(self):
+        try:
+            nuevo = IndiceBusqueda(self.nombre, self.cargar)
+            for clave, texto, activo in self.cargar(): nuevo._agregar(clave, texto, activo, ordenar=False)
+            nuevo.frases.sort(); nuevo.palabras.sort()
+            with self.lock:
+                self.claves, self.docs, self.frases, self.palabras, self.gramas = nuevo.claves, nuevo.docs, nuevo.frases, nuevo.palabras, nuevo.gramas
+                self.cargado_en = time.monotonic()
+        finally: self.recargando = False
+
+    def actualizar(self, clave, texto, activo=True):
+        with self.lock:
+            if self.cargado_en is None: return  # aún no se carga: la primera búsqueda lo leerá de la base
+            self._quitar(clave); self._agregar(clave, texto, activo)
+
+    def invalidar(self):
+        with self.lock: self.vencido = True  # se sigue respondiendo con lo anterior mientras se reconstruye
+
+    def _vigente(self):
+        # Las escrituras de otros workers solo llegan por cache_ref.sincronizar(): la búsqueda no pasa por
+        # obtener, así que lo llama aquí (consulta cache_versiones a lo más cada CACHE_CHEQUEO segundos)
+        cache_ref.sincronizar()
+        if self.cargado_en is None: self.reconstruir(); return
+        if (self.vencido or time.monotonic() - self.cargado_en > BUSQUEDA_TTL) and not self.recargando:
+            self.recargando = True; self.vencido = False
+            threading.Thread(target=self.reconstruir, daemon=True).start()
+
+    def _contienen(self, *tokens):
+        listas = sorted((self.gramas.get(g, set()) for t in tokens for g in trigramas(t)), key=len)
+        return set.intersection(*listas) if listas else set()
+
+    def buscar(self, q, limite=10, solo_activos=False):
+        tokens = normalizar(q).split()
+        if not tokens: return []
+        self._vigente()
+        frase = ' '.join(tokens); largos = [t for t in tokens if len(t) >= 3]
+        with self.lock:
+            # Relevancia por niveles: el texto parte con lo tecleado > alguna palabra parte con el primer término > lo contiene.
+            # Los dos primeros son rangos ordenados (bisect), el último una intersección de trigramas que solo se
+            # calcula si hace falta; se corta apenas se llena el límite.
+            def contienen(): yield from (self._contienen(*largos) if largos else ())
+            res = []; vistos = set()
+            for i in itertools.chain(_con_prefijo(self.frases, frase), _con_prefijo(self.palabras, tokens[0]), contienen()):
+                if i in vistos: continue
+                vistos.add(i); d = self.docs[i]
+                if d and (d[2] or not solo_activos) and all(t in d[1] for t in tokens):
+                    res.append(d[0])
+                    if len(res) >= limite: break
+            if res or len(tokens[-1]) < 4: return res
+            # Sin coincidencia exacta: se toleran errores de tipeo por similitud de trigramas
+            qgramas = set().union(*(trigramas(t) for t in tokens)); votos = Counter()
+            for g in qgramas: votos.update(self.gramas.get(g, ()))
+            minimo = max(2, len(qgramas) // 2)
+            parecidos = [(n, i) for i, n in votos.items() if n >= minimo and self.docs[i] and (self.docs[i][2] or not solo_activos)]
+            return [self.docs[i][0] for n, i in heapq.nlargest(limite, parecidos)]
+
+    def estado(self):
+        with self.lock:
+            return {'indice': self.nombre, 'docs': len(self.claves), 'gramas': len(self.gramas), 'cargado': self.cargado_en is not None}
+
+indice_productos = IndiceBusqueda('productos', lambda: [(r['id'], f"{r['nombre']} {r['id']}", True) for r in catalogo_productos().values()])
+indice_trabajadores = IndiceBusqueda('trabajadores', lambda: [(r['rut'], f"{r['nombre']} {r['rut']}", r['estado'] == 'ACTIVO') for r in nomina_trabajadores().values()])
+cache_ref.suscribir('productos', indice_productos.invalidar)
+cache_ref.suscribir('trabajadores', indice_trabajadores.invalidar)
+
+def filas_por_clave(tabla, col, claves):
+    if not claves: return []
+    rows = ejecutar_sql(f"SELECT * FROM {tabla} WHERE {col} IN ({','.join(['%s'] * len(claves))})", tuple(claves))
+    por_clave = {r[col]: dict(r) for r in rows}
+    return [por_clave[k] for k in claves if k in por_clave]
+
+def buscar_productos(q, limite=10):
+    if BUSQUEDA_MOTOR == 'pg_trgm' and DATABASE_URL:
+        q = q.strip().lower()
+        if not q: return []
+        return [dict(r) for r in ejecutar_sql("SELECT * FROM productos WHERE lower(nombre) LIKE %s ORDER BY similarity(lower(nombre), %s) DESC, nombre LIMIT %s", (f'%{q}%', q, limite))]
+    return filas_por_clave('productos', 'id', indice_productos.buscar(q, limite))
+
+def buscar_trabajadores(q, limite=5):
+    if BUSQUEDA_MOTOR == 'pg_trgm' and DATABASE_URL:
+        q = q.upper().replace('.', '').strip()
+        if not q: return []
+        return [dict(r) for r in ejecutar_sql("SELECT * FROM trabajadores WHERE (rut || ' ' || upper(nombre)) LIKE %s AND estado='ACTIVO' ORDER BY similarity(rut || ' ' || upper(nombre), %s) DESC LIMIT %s", (f'%{q}%', q, limite))]
+    # El índice puede ir atrasado respecto de otro worker que desactivó a alguien: manda el estado de la fila leída
+    return [t for t in filas_por_clave('trabajadores', 'rut', indice_trabajadores.buscar(q, limite, solo_activos=True)) if t['estado'] == 'ACTIVO']
+
+# --- AUDITORIA (escritura diferida) ---
+# Los eventos (logins, movimientos, cambios de admin) van a una cola acotada en memoria y un hilo los escribe por
+# lotes con executemany: el request no espera el INSERT. AUDITORIA_MODO='sincrono' escribe dentro del request
+# (nada queda en memoria si el proceso muere). Con la cola llena el request espera hasta AUDITORIA_ESPERA y, si
+# sigue llena, escribe su evento él mismo: se frena al que produce, nunca se descarta un evento.
+AUDITORIA_MODO = os.environ.get('AUDITORIA_MODO', 'diferido')  # 'diferido' | 'sincrono'
+AUDITORIA_COLA = int(os.environ.get('AUDITORIA_COLA', 10000))
+AUDITORIA_LOTE = int(os.environ.get('AUDITORIA_LOTE', 500))
+AUDITORIA_INTERVALO = float(os.environ.get('AUDITORIA_INTERVALO', 1))
+AUDITORIA_ESPERA = float(os.environ.get('AUDITORIA_ESPERA', 0.5))
+TABLAS_AUDITORIA = {
+    'login_logs': "INSERT INTO login_logs (usuario, fecha, ip_address, device_info) VALUES (%s,%s,%s,%s)",
+    'auditoria': "INSERT INTO auditoria (fecha, usuario, accion, detalle) VALUES (%s,%s,%s,%s)",
+}
+
+class RegistroDiferido:
+    def __init__(self, tablas):
+        self.tablas = tablas; self.lock = threading.Lock(); self.pid = None; self.hilo = None
+        self.stats = Counter()
+
+    def _arrancar(self):
+        # Tras un fork (gunicorn) el hilo del padre no existe en el hijo: cada proceso arranca el suyo
+        with self.lock:
+            if self.pid == os.getpid() and self.hilo.is_alive(): return
+            if self.pid != os.getpid(): self.cola = queue.Queue(maxsize=AUDITORIA_COLA); self.pendiente = []; self.pid = os.getpid()
+            self.parar = threading.Event()
+            self.hilo = threading.Thread(target=self._bucle, name='auditoria', daemon=True); self.hilo.start()
 
-init_db()
+    def registrar(self, tabla, fila):
+        if AUDITORIA_MODO == 'sincrono': return self._escribir([(tabla, fila)])
+        if self.pid != os.getpid() or not self.hilo.is_alive(): self._arrancar()
+        try: self.cola.put((tabla, fila), timeout=AUDITORIA_ESPERA); self.stats['encolados'] += 1
+        except queue.Full: self.stats['cola_llena'] += 1; self._escribir([(tabla, fila)])
+
+    def _sacar_lote(self, espera):
+        try: lote = [self.cola.get(timeout=espera)]
+        except queue.Empty: return []
+        while len(lote) < AUDITORIA_LOTE:
+            try: lote.append(self.cola.get_nowait())
+            except queue.Empty: break
+        return lote
+
+    def _escribir(self, lote):
+        por_tabla = {}
+        for tabla, fila in lote: por_tabla.setdefault(tabla, []).append(fila)
+        with transaccion() as (cur, db):
+            for tabla, filas in por_tabla.items(): sql_lote(cur, db, self.tablas[tabla], filas)
+        self.stats['escritos'] += len(lote); self.stats['lotes'] += 1
+
+    def _bucle(self):
+        while not (self.parar.is_set() and not self.pendiente and self.cola.empty()):
+            self.pendiente = self.pendiente or self._sacar_lote(AUDITORIA_INTERVALO)
+            if not self.pendiente: continue
+            try: self._escribir(self.pendiente); self.pendiente = []
+            except Exception as e:
+                # Base caída o bloqueada: se reintenta el mismo lote; mientras tanto la cola se llena y frena a los requests
+                self.stats['errores'] += 1; print(f"Auditoría: error al escribir {len(self.pendiente)} eventos: {e}")
+                if self.parar.wait(min(30, 2 ** min(self.stats['errores'], 5))): break
+
+    def vaciar(self, timeout=10):
+        """Escribe lo que haya en cola desde el hilo que llama (cierre del proceso, CLI, pruebas)."""
+        if self.pid != os.getpid(): return
+        fin = time.time() + timeout
+        while time.time() < fin:
+            self.pendiente = self.pendiente or self._sacar_lote(0)
+            if not self.pendiente: return
+            self._escribir(self.pendiente); self.pendiente = []
+
+    def cerrar(self, timeout=10):
+        if self.pid != os.getpid(): return
+        self.parar.set(); self.hilo.join(timeout)
+        try: self.vaciar(timeout)
+        except Exception as e: print(f"Auditoría: {len(self.pendiente) + self.cola.qsize()} eventos sin escribir al cerrar: {e}")
+
+    def estado(self):
+        return {'modo': AUDITORIA_MODO, 'en_cola': self.cola.qsize() if self.pid == os.getpid() else 0, 'max_cola': AUDITORIA_COLA, **self.stats}
+
+auditoria = RegistroDiferido(TABLAS_AUDITORIA)
+atexit.register(auditoria.cerrar)
+
+def auditar(accion, detalle=''):
+    auditoria.registrar('auditoria', (get_str_now(), session.get('user'), accion, detalle))
+
+# --- EVENTOS EN VIVO (SSE del dashboard) ---
+# El dashboard abre /api/eventos y aplica deltas (salida, devolución, stock) en vez de recargar la página.
+# Las escrituras publican dentro de su transacción: el evento sale solo si hubo commit. El reparto entre workers
+# va por la base y no por visor: Postgres con LISTEN/NOTIFY, SQLite con la tabla eventos que un hilo por worker
+# lee cada EVENTOS_INTERVALO segundos. Cada worker tiene un solo listener (y solo mientras haya visores) que
+# reparte a las colas de sus conexiones SSE. Un visor que no alcanza a leer recibe 'resync' y se reconecta.
+# Cada evento lleva su posición (eventos.id en SQLite, txid en Postgres) y el estado inicial se lee en una sola foto
+# junto con su corte: los eventos que esa foto ya incluye se descartan, así un delta no se suma dos veces.
+EVENTOS_CANAL = 'irontrace_eventos'
+EVENTOS_INTERVALO = float(os.environ.get('EVENTOS_INTERVALO', 1))
+EVENTOS_LATIDO = 15    # seg. entre comentarios keep-alive hacia el navegador
+EVENTOS_COLA = 200     # eventos pendientes por visor antes de pedirle resync
+EVENTOS_MAX_BYTES = 7900  # NOTIFY admite hasta 8000 bytes de payload
+STOCK_ALERTA = 10
+RESYNC = '{"tipo": "resync"}'
+
+class Visor:
+    def __init__(self): self.cola = queue.Queue(EVENTOS_COLA); self.atrasado = False; self.corte = None
+
+    def incluido(self, pos):
+        """True si el estado inicial ya trae el evento. corte = (xmin, xmax, en curso), como un snapshot de Postgres."""
+        if pos is None or self.corte is None: return False
+        xmin, xmax, en_curso = self.corte
+        return pos < xmin or (pos < xmax and pos not in en_curso)
+
+class CanalEventos:
+    def __init__(self):
+        self.lock = threading.Lock(); self.visores = set(); self.hilo = None; self.pid = None
+        self.conn = None; self.ultimo = 0; self.purgado = 0; self.stats = Counter()
+
+    def publicar(self, cur, db_type, tipo, datos):
+        """Dentro de la transacción de la escritura."""
+        payload = app.json.dumps({'tipo': tipo, **datos})
+        if db_type == 'POSTGRES':
+            sql_tx(cur, db_type, "SELECT pg_notify(%s, txid_current() || ' ' || %s)", (EVENTOS_CANAL, payload if len(payload.encode()) <= EVENTOS_MAX_BYTES else RESYNC))
+        else:
+            sql_tx(cur, db_type, "INSERT INTO eventos (fecha, datos) VALUES (%s,%s)", (get_str_now(), payload))
+            if time.monotonic() - self.purgado > 3600:  # los eventos solo sirven unos segundos
+                self.purgado = time.monotonic()
+                sql_tx(cur, db_type, "DELETE FROM eventos WHERE fecha < %s", ((get_chile_time() - timedelta(hours=1)).strftime("%Y-%m-%d %H:%M:%S"),))
+        self.stats['publicados'] += 1
+
+    def suscribir(self):
+        v = Visor()
+        with self.lock:
+            self._arrancar(); self.visores.add(v)
+        return v
+
+    def desuscribir(self, v):
+        with self.lock: self.visores.discard(v)
+
+    def _arrancar(self):
+        # El punto de partida (LISTEN o último id) se fija antes de devolver: lo que se confirme después del
+        # estado inicial del visor le llega sí o sí; lo que ya estaba en ese estado lo descarta Visor.incluido
+        if self.hilo and self.hilo.is_alive() and self.pid == os.getpid(): return
+        self.pid = os.getpid()
+        if DATABASE_URL: self.conn = self._escuchar()
+        else: self.ultimo = ejecutar_sql("SELECT COALESCE(MAX(id), 0) AS m FROM eventos", one=True)['m']
+        self.hilo = threading.Thread(target=self._bucle_pg if DATABASE_URL else self._bucle_sqlite, daemon=True); self.hilo.start()
+
+    def _escuchar(self):
+        conn = psycopg2.connect(DATABASE_URL, connect_timeout=POOL_TIMEOUT); conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        conn.cursor().execute(f"LISTEN {EVENTOS_CANAL}")
+        return conn
+
+    def _seguir(self):
+        # Sin visores el hilo termina (y suelta su conexión); el próximo suscribir lo vuelve a levantar
+        with self.lock:
+            if self.visores: return True
+            self.hilo = None; return False
+
+    def _repartir(self, payload, pos=None):
+        with self.lock: visores = list(self.visores)
+        for v in visores:
+            try: v.cola.put_nowait((pos, payload))
+            except queue.Full: v.atrasado = True; self.desuscribir(v); self.stats['atrasados'] += 1
+        self.stats['repartidos'] += 1
+
+    def _bucle_pg(self):
+        conn = self.conn
+        try:
+            while self._seguir():
+                try:
+                    if select.select([conn], [], [], EVENTOS_LATIDO) == ([], [], []): continue
+                    conn.poll()
+                    while conn.notifies:
+                        pos, _, payload = conn.notifies.pop(0).payload.partition(' '); self._repartir(payload, int(pos))
+                except Exception as e:
+                    # Se cortó el LISTEN: lo que pasó mientras tanto se perdió, los visores piden el estado de nuevo
+                    print(f"Listener de eventos caído: {e}"); self.stats['reconexiones'] += 1
+                    try: conn.close()
+                    except Exception: pass
+                    conn = self.conn = self._reconectar()
+                    if conn is None: return
+                    self._repartir(RESYNC)
+        finally:
+            try: conn.close()
+            except Exception: pass
+
+    def _reconectar(self):
+        # Dentro del hilo y con espera creciente: una caída larga de Postgres no mata el listener. None si mientras
+        # tanto se fueron todos los visores (el próximo suscribir arranca otro hilo)
+        espera = 1
+        while self._seguir():
+            time.sleep(espera)
+            try: return self._escuchar()
+            except Exception as e: print(f"Reconexión del listener falló: {e}"); espera = min(espera * 2, 30)
+        return None
+
+    def _bucle_sqlite(self):
+        while self._seguir():
+            time.sleep(EVENTOS_INTERVALO)
+            try:
+                for r in ejecutar_sql("SELECT id, datos FROM eventos WHERE id > %s ORDER BY id", (self.ultimo,)):
+                    self._repartir(r['datos'], r['id']); self.ultimo = r['id']
+            except Exception as e: print(f"Lectura de eventos falló: {e}")
+
+    def estado(self):
+        with self.lock: return dict(self.stats, visores=len(self.visores), listener=bool(self.hilo and self.hilo.is_alive()))
+
+eventos = CanalEventos()
+
+def stock_evento(cur, db_type, ids):
+    """Stock ya actualizado de esos productos, para las alertas del dashboard (bajo el lock de la transacción)."""
+    if not ids: return []
+    return [dict(r) for r in sql_tx(cur, db_type, f"SELECT id, nombre, tipo, stock FROM productos WHERE id IN ({','.join(['%s'] * len(ids))}) ORDER BY id", tuple(sorted(ids))).fetchall()]
 
 # --- RUTAS ---
 @app.route('/')
@@ -117,8 +1135,7 @@ def login():
                 # REGISTRAR LOG DE CONEXIÓN
                 ip = request.headers.get('X-Forwarded-For', request.remote_addr) # IP Real en Proxy
                 device = request.user_agent.string # Navegador / SO
-                ejecutar_sql("INSERT INTO login_logs (usuario, fecha, ip_address, device_info) VALUES (%s,%s,%s,%s)", 
-                             (u['username'], get_str_now(), ip, device))
+                auditoria.registrar('login_logs', (u['username'], get_str_now(), ip, device))
                 
                 return redirect(url_for('panel_operador') if u['rol'] == 'operador' else url_for('dashboard'))
             else: flash('⛔ Acceso Denegado')
@@ -132,21 +1149,127 @@ def logout(): session.clear(); return redirect(url_for('login'))
 def dashboard():
     if 'user' not in session: return redirect(url_for('login'))
     if session.get('rol') == 'operador': return redirect(url_for('panel_operador'))
-    stats = {'insumos_hoy':0, 'prestamos_valor':0, 'prestamos_qty':0}
-    en_uso = []; alertas = []
-    try:
-        hoy = get_chile_time().strftime("%Y-%m-%d")
-        res = ejecutar_sql("SELECT SUM(p.cantidad * prod.precio) as t FROM prestamos p JOIN productos prod ON p.tool_id=prod.id WHERE p.tipo_item='INSUMO' AND p.fecha_salida LIKE %s", (f'{hoy}%',), one=True)
-        stats['insumos_hoy'] = res['t'] or 0
-        res2 = ejecutar_sql("SELECT SUM(prod.precio) as t, COUNT(*) as c FROM prestamos p JOIN productos prod ON p.tool_id=prod.id WHERE p.estado='ACTIVO'", one=True)
-        if res2: stats['prestamos_valor'] = res2['t'] or 0; stats['prestamos_qty'] = res2['c']
-        alertas = ejecutar_sql("SELECT * FROM productos WHERE tipo='INSUMO' AND stock <= 10 ORDER BY stock ASC LIMIT 5")
-        en_uso = ejecutar_sql("SELECT p.*, prod.nombre FROM prestamos p JOIN productos prod ON p.tool_id=prod.id WHERE p.estado='ACTIVO' ORDER BY p.fecha_salida DESC LIMIT 20")
-    except: pass
+    try: datos = datos_dashboard()
+    except: datos = {'stats': {'insumos_hoy':0, 'prestamos_valor':0, 'prestamos_qty':0}, 'en_uso': [], 'alertas': []}
     server_info = {'time_server': get_chile_time().strftime("%H:%M:%S (CLT)"), 'db_mode': 'PostgreSQL' if DATABASE_URL else 'SQLite', 'os': platform.system()}
-    config_raw = ejecutar_sql("SELECT * FROM config")
-    config = {row['clave']: row['valor'] for row in config_raw} if config_raw else {}
-    return render_template('dashboard.html', stats=stats, en_uso=en_uso, alertas=alertas, rol=session['rol'], server=server_info, config=config)
+    config = obtener_config()
+    return render_template('dashboard.html', **datos, stock_alerta=STOCK_ALERTA, rol=session['rol'], server=server_info, config=config)
+
+def datos_dashboard(cur=None, db=None):
+    consultar = (lambda sql, params=(): sql_tx(cur, db, sql, params).fetchall()) if cur else ejecutar_sql
+    hoy = get_chile_time().strftime("%Y-%m-%d")
+    res = {r['clave']: r['valor'] for r in consultar("SELECT clave, valor FROM resumen_contadores UNION ALL SELECT 'insumos_hoy', insumos_valor FROM resumen_diario WHERE dia=%s", (hoy,))}
+    return {'stats': {'insumos_hoy': res.get('insumos_hoy') or 0, 'prestamos_valor': res.get('activos_valor') or 0, 'prestamos_qty': res.get('activos_qty') or 0},
+            'alertas': [dict(r) for r in consultar("SELECT * FROM productos WHERE tipo='INSUMO' AND stock <= %s ORDER BY stock ASC LIMIT 5", (STOCK_ALERTA,))],
+            'en_uso': [dict(r) for r in consultar("SELECT p.*, prod.nombre FROM prestamos p JOIN productos prod ON p.tool_id=prod.id WHERE p.estado='ACTIVO' ORDER BY p.fecha_salida DESC LIMIT 20")]}
+
+def foto_dashboard():
+    """(estado, corte) leídos en una misma foto de la base: corte dice qué eventos ya están dentro del estado."""
+    with conexion_db() as (conn, db):
+        cur = conn.cursor()
+        try:
+            if db == 'POSTGRES':
+                # REPEATABLE READ: todas las consultas ven la foto de la primera, que es la del corte
+                cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+                xmin, xmax, en_curso = sql_tx(cur, db, "SELECT txid_current_snapshot()::text AS s").fetchone()['s'].split(':')
+                corte = (int(xmin), int(xmax), {int(x) for x in en_curso.split(',') if x})
+            else:
+                cur.execute("BEGIN")  # en WAL la foto se fija en la primera lectura y dura hasta el fin de la transacción
+                m = sql_tx(cur, db, "SELECT COALESCE(MAX(id), 0) AS m FROM eventos").fetchone()['m'] + 1; corte = (m, m, set())
+            return datos_dashboard(cur, db), corte
+        finally: conn.rollback(); cur.close()
+
+@app.route('/api/eventos')
+def api_eventos():
+    # Un visor cuesta una cola en memoria; a la base solo le llega el estado inicial al conectar
+    if 'user' not in session or session.get('rol') == 'operador': return "Acceso Denegado", 403
+    visor = eventos.suscribir()
+    try: datos, visor.corte = foto_dashboard(); inicial = app.json.dumps({'tipo': 'estado', **datos})
+    except Exception: eventos.desuscribir(visor); raise
+    def stream():
+        try:
+            yield f"retry: 3000\ndata: {inicial}\n\n"
+            while not visor.atrasado:
+                try: pos, payload = visor.cola.get(timeout=EVENTOS_LATIDO)
+                except queue.Empty: yield ": latido\n\n"; continue
+                if not visor.incluido(pos): yield f"data: {payload}\n\n"
+            yield f"data: {RESYNC}\n\n"
+        finally: eventos.desuscribir(visor)
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# --- PAGINACION POR CURSOR ---
+# Las listas largas se sirven de a PAGINA_TAM filas. En vez de OFFSET se usa la última clave vista (keyset):
+# WHERE (orden, id) > (último orden, último id) ORDER BY orden, id LIMIT n entra al índice en ese punto, así que
+# la página 500 cuesta lo mismo que la primera. Filtros y orden se resuelven en la base.
+PAGINA_TAM = int(os.environ.get('PAGINA_TAM', 50)); PAGINA_MAX = 200
+
+def codificar_cursor(valores): return base64.urlsafe_b64encode(app.json.dumps(valores).encode()).decode()
+
+def decodificar_cursor(cursor, n):
+    try: valores = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception: raise ValueError("Cursor inválido")
+    if not isinstance(valores, list) or len(valores) != n: raise ValueError("Cursor inválido")
+    return valores
+
+def paginar(sql, cond, params, orden, despues=None, limite=PAGINA_TAM, desc=False):
+    """orden: [(expresión SQL, columna en la fila)], la última única. Devuelve (filas, cursor de la página siguiente o None)."""
+    cond = list(cond); params = list(params); cols = ", ".join(e for e, _ in orden)
+    if despues:
+        cond.append(f"({cols}) {'<' if desc else '>'} ({', '.join(['%s'] * len(orden))})"); params += decodificar_cursor(despues, len(orden))
+    if cond: sql += " WHERE " + " AND ".join(cond)
+    sql += " ORDER BY " + ", ".join(e + (" DESC" if desc else "") for e, _ in orden) + f" LIMIT {limite + 1}"
+    filas = [dict(r) for r in ejecutar_sql(sql, tuple(params))]
+    if len(filas) <= limite: return filas, None
+    filas = filas[:limite]
+    return filas, codificar_cursor([filas[-1][k] for _, k in orden])
+
+def limite_pagina(args):
+    try: return max(1, min(int(args.get('limite', PAGINA_TAM)), PAGINA_MAX))
+    except ValueError: return PAGINA_TAM
+
+ORDEN_TRABAJADORES = {'nombre': [('nombre', 'nombre'), ('rut', 'rut')], 'rut': [('rut', 'rut')]}
+ORDEN_PRODUCTOS = {'id': [('id', 'id')], 'nombre': [('nombre', 'nombre'), ('id', 'id')], 'stock': [('stock', 'stock'), ('id', 'id')]}
+
+def pagina_trabajadores(args):
+    cond = []; params = []
+    q = args.get('q', '').replace('.', '').strip().upper()
+    if q: cond.append("(rut LIKE %s OR UPPER(nombre) LIKE %s)"); params += [f'{q}%', f'%{q}%']
+    if args.get('estado'): cond.append("estado = %s"); params.append(args['estado'])
+    if args.get('faena'): cond.append("faena = %s"); params.append(args['faena'])
+    orden = ORDEN_TRABAJADORES.get(args.get('orden'), ORDEN_TRABAJADORES['nombre'])
+    return paginar("SELECT * FROM trabajadores", cond, params, orden, args.get('despues'), limite_pagina(args))
+
+def pagina_productos(args):
+    cond = []; params = []
+    q = args.get('q', '').strip().upper()
+    if q: cond.append("(id LIKE %s OR UPPER(nombre) LIKE %s)"); params += [f'{q}%', f'%{q}%']
+    if args.get('tipo'): cond.append("tipo = %s"); params.append(args['tipo'])
+    if args.get('stock_max', '').isdigit(): cond.append("stock <= %s"); params.append(int(args['stock_max']))
+    orden = ORDEN_PRODUCTOS.get(args.get('orden'), ORDEN_PRODUCTOS['id'])
+    return paginar("SELECT * FROM productos", cond, params, orden, args.get('despues'), limite_pagina(args))
+
+def pagina_movimientos(args):
+    # Mismos filtros que la exportación (desde, hasta, worker, tool) más el texto libre de la pantalla de reportes
+    cond, params = cond_movimientos(filtros_export(args))
+    q = args.get('q', '').strip().upper()
+    if q: cond.append("(p.worker_id LIKE %s OR p.tool_id LIKE %s OR UPPER(p.nombre) LIKE %s)"); params += [f"%{q.replace('.', '')}%", f'%{q}%', f'%{q}%']
+    if args.get('estado'): cond.append("p.estado = %s"); params.append(args['estado'])
+    return paginar(SQL_MOVIMIENTOS, cond, params, [('p.fecha_salida', 'fecha_salida'), ('p.id', 'id')], args.get('despues'), limite_pagina(args), desc=True)
+
+def api_pagina(fn):
+    if session.get('rol') not in ['admin', 'supervisor']: return jsonify({'error': 'Acceso Denegado'}), 403
+    try: filas, siguiente = fn(request.args)
+    except ValueError as e: return jsonify({'error': str(e)}), 400
+    return jsonify({'filas': filas, 'siguiente': siguiente})
+
+@app.route('/api/trabajadores')
+def api_trabajadores(): return api_pagina(pagina_trabajadores)
+
+@app.route('/api/productos')
+def api_productos(): return api_pagina(pagina_productos)
+
+@app.route('/api/movimientos')
+def api_movimientos(): return api_pagina(pagina_movimientos)
 
 # --- TRABAJADORES ---
 @app.route('/trabajadores')
@@ -157,8 +1280,9 @@ def gestion_trabajadores(rut=None):
     if rut:
         rut_clean = rut.replace('.', '').strip().upper()
         trabajador_edit = ejecutar_sql("SELECT * FROM trabajadores WHERE rut=%s", (rut_clean,), one=True)
-    trabajadores = ejecutar_sql("SELECT * FROM trabajadores ORDER BY nombre ASC")
-    return render_template('trabajadores.html', trabajadores=trabajadores, edit=trabajador_edit)
+    try: trabajadores, siguiente = pagina_trabajadores(request.args)
+    except ValueError: trabajadores, siguiente = pagina_trabajadores({})
+    return render_template('trabajadores.html', trabajadores=trabajadores, siguiente=siguiente, filtros=request.args, edit=trabajador_edit)
 
 @app.route('/trabajadores/guardar', methods=['POST'])
 def guardar_trabajador():
@@ -169,6 +1293,8 @@ def guardar_trabajador():
         ejecutar_sql('DELETE FROM trabajadores WHERE rut=%s', (rut,))
         ejecutar_sql('INSERT INTO trabajadores (rut, nombre, correo, seccion, faena, estado) VALUES (%s,%s,%s,%s,%s,%s)', 
                      (rut, request.form['nombre'], request.form['correo'], request.form['seccion'], request.form['faena'], estado))
+        indice_trabajadores.actualizar(rut, f"{request.form['nombre']} {rut}", estado == 'ACTIVO'); cache_ref.tocar('trabajadores')
+        auditar('TRABAJADOR', f"{rut} {request.form['nombre']} {estado}")
         flash('Trabajador guardado.')
     except Exception as e: flash(f'Error: {e}')
     return redirect(url_for('gestion_trabajadores'))
@@ -176,7 +1302,7 @@ def guardar_trabajador():
 @app.route('/fix_estados')
 def fix_estados():
     if session.get('rol') != 'admin': return "Acceso Denegado"
-    try: ejecutar_sql("UPDATE trabajadores SET estado = 'ACTIVO' WHERE estado IS NULL OR estado = ''"); flash("✅ Reparados.")
+    try: ejecutar_sql("UPDATE trabajadores SET estado = 'ACTIVO' WHERE estado IS NULL OR estado = ''"); cache_ref.tocar('trabajadores'); indice_trabajadores.invalidar(); flash("✅ Reparados.")
     except Exception as e: flash(f"Error: {e}")
     return redirect(url_for('gestion_trabajadores'))
 
@@ -185,23 +1311,25 @@ def fix_estados():
 def vista_inventario():
     if session.get('rol') not in ['admin', 'supervisor']: return redirect(url_for('login'))
     try:
-        productos = ejecutar_sql('SELECT * FROM productos ORDER BY id')
+        productos, siguiente = pagina_productos(request.args)
         facturas = ejecutar_sql('SELECT * FROM facturas ORDER BY id DESC LIMIT 20')
         bajas = ejecutar_sql('SELECT * FROM bajas ORDER BY id DESC LIMIT 20')
-    except: productos, facturas, bajas = [], [], []
-    return render_template('inventario.html', productos=productos, facturas=facturas, bajas=bajas)
+    except: productos, siguiente, facturas, bajas = [], None, [], []
+    return render_template('inventario.html', productos=productos, siguiente=siguiente, filtros=request.args, facturas=facturas, bajas=bajas)
 
 @app.route('/inventario/dar_baja', methods=['POST'])
 def dar_baja_producto():
     if session.get('rol') not in ['admin', 'supervisor']: return "Acceso Denegado"
     pid = request.form['id_producto']; cant = int(request.form['cantidad']); motivo = request.form['motivo']
     try:
-        prod = ejecutar_sql("SELECT * FROM productos WHERE id=%s", (pid,), one=True)
-        if prod and prod['stock'] >= cant:
-            ejecutar_sql("UPDATE productos SET stock = stock - %s WHERE id=%s", (cant, pid))
-            ejecutar_sql("INSERT INTO bajas (producto_id, cantidad, motivo, fecha, usuario) VALUES (%s,%s,%s,%s,%s)", (pid, cant, motivo, get_str_now(), session['user']))
-            flash(f"⚠️ Baja registrada: {pid}")
-        else: flash("Error: Stock insuficiente")
+        with transaccion() as (cur, db):
+            prod = sql_tx(cur, db, "SELECT nombre, stock, tipo FROM productos WHERE id=%s" + (" FOR UPDATE" if db == 'POSTGRES' else ""), (pid,)).fetchone()
+            if not prod or prod['stock'] < cant: raise ValueError("Stock insuficiente")
+            sql_tx(cur, db, "UPDATE productos SET stock = stock - %s WHERE id=%s", (cant, pid))
+            sql_tx(cur, db, "INSERT INTO bajas (producto_id, cantidad, motivo, fecha, usuario) VALUES (%s,%s,%s,%s,%s)", (pid, cant, motivo, get_str_now(), session['user']))
+            if prod['tipo'] == 'HERRAMIENTA': aplicar_resumen(cur, db, {'bodega_herramientas': -cant})
+            eventos.publicar(cur, db, 'stock', {'stock': [{'id': pid, 'nombre': prod['nombre'], 'tipo': prod['tipo'], 'stock': prod['stock'] - cant}]})
+        auditar('BAJA', f"{pid} x{cant} ({motivo})"); flash(f"⚠️ Baja registrada: {pid}")
     except Exception as e: flash(f"Error: {e}")
     return redirect(url_for('vista_inventario'))
 
@@ -210,51 +1338,197 @@ def ingreso_manual_stock():
     if session.get('rol') not in ['admin', 'supervisor']: return "Acceso Denegado"
     try:
         pid = request.form['id_producto'].strip(); cant = int(request.form['cantidad']); doc = request.form.get('num_documento', 'MANUAL')
-        ejecutar_sql('INSERT INTO facturas (numero, fecha, usuario) VALUES (%s,%s,%s)', (f"{doc} ({pid})", get_str_now(), session['user']))
-        prod = ejecutar_sql('SELECT * FROM productos WHERE id=%s', (pid,), one=True)
-        if prod: ejecutar_sql('UPDATE productos SET stock = stock + %s WHERE id=%s', (cant, pid))
-        else: ejecutar_sql('INSERT INTO productos (id, nombre, precio, stock, tipo) VALUES (%s,%s,%s,%s,%s)', (pid, f'NUEVO {pid}', 0, cant, 'INSUMO'))
-        flash(f'✅ Stock actualizado')
+        with transaccion() as (cur, db):
+            sql_tx(cur, db, 'INSERT INTO facturas (numero, fecha, usuario) VALUES (%s,%s,%s)', (f"{doc} ({pid})", get_str_now(), session['user']))
+            prod = sql_tx(cur, db, 'SELECT tipo FROM productos WHERE id=%s', (pid,)).fetchone()
+            if prod: sql_tx(cur, db, 'UPDATE productos SET stock = stock + %s WHERE id=%s', (cant, pid))
+            else: sql_tx(cur, db, 'INSERT INTO productos (id, nombre, precio, stock, tipo) VALUES (%s,%s,%s,%s,%s)', (pid, f'NUEVO {pid}', 0, cant, 'INSUMO'))
+            if prod and prod['tipo'] == 'HERRAMIENTA': aplicar_resumen(cur, db, {'bodega_herramientas': cant})
+            eventos.publicar(cur, db, 'stock', {'stock': stock_evento(cur, db, [pid])})
+        if not prod: indice_productos.actualizar(pid, f'NUEVO {pid} {pid}'); cache_ref.tocar('productos')
+        auditar('INGRESO', f"{pid} x{cant} doc {doc}"); flash(f'✅ Stock actualizado')
     except Exception as e: flash(f'Error: {e}')
     return redirect(url_for('vista_inventario'))
 
+# --- EXPORTACIONES (historial completo en CSV o PDF) ---
+# Se lee por lotes (cursor del lado del servidor en Postgres, fetchmany en SQLite) y se responde en streaming:
+# la memoria no depende de cuántas filas tenga el rango y el primer byte sale con el primer lote.
+EXPORT_LOTE = int(os.environ.get('EXPORT_LOTE', 2000))
+COLUMNAS_EXPORT = ['id', 'transaction_id', 'fecha_salida', 'fecha_regreso', 'worker_id', 'tool_id', 'nombre', 'tipo_item', 'cantidad', 'precio', 'estado']
+
+def filtros_export(args):
+    f = {'desde': args.get('desde', '').strip(), 'hasta': args.get('hasta', '').strip(),
+         'worker': args.get('worker', '').upper().replace('.', '').strip(), 'tool': args.get('tool', '').strip().upper()}
+    for k in ('desde', 'hasta'):
+        if f[k]: datetime.strptime(f[k], "%Y-%m-%d")  # ValueError si viene mal
+    return f
+
+SQL_MOVIMIENTOS = "SELECT p.id, p.transaction_id, p.fecha_salida, p.fecha_regreso, p.worker_id, p.tool_id, p.nombre, p.tipo_item, p.cantidad, p.precio, p.estado FROM movimientos p"
+
+def cond_movimientos(f):
+    cond = []; params = []
+    if f['desde']: cond.append("p.fecha_salida >= %s"); params.append(f['desde'])
+    if f['hasta']: cond.append("p.fecha_salida < %s"); params.append((datetime.strptime(f['hasta'], "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d"))
+    if f['worker']: cond.append("p.worker_id = %s"); params.append(f['worker'])
+    if f['tool']: cond.append("p.tool_id = %s"); params.append(f['tool'])
+    return cond, params
+
+def sql_movimientos(f):
+    cond, params = cond_movimientos(f); sql = SQL_MOVIMIENTOS
+    if cond: sql += " WHERE " + " AND ".join(cond)
+    return sql + " ORDER BY p.fecha_salida DESC, p.id DESC", tuple(params)
+
+def leer_por_lotes(sql, params=(), lote=EXPORT_LOTE):
+    with conexion_db() as (conn, db_type):
+        if db_type == 'POSTGRES':
+            cur = conn.cursor(name=f"export_{uuid.uuid4().hex}", cursor_factory=RealDictCursor); cur.itersize = lote
+        else: cur = conn.cursor(); sql = sql.replace('%s', '?')
+        try:
+            cur.execute(sql, params)
+            while True:
+                filas = cur.fetchmany(lote)
+                if not filas: break
+                yield filas
+        finally: cur.close()
+
+def exportar_csv(filas_por_lote):
+    buf = io.StringIO(); w = csv.writer(buf)
+    w.writerow(COLUMNAS_EXPORT); yield '\ufeff' + buf.getvalue()
+    for filas in filas_por_lote:
+        buf.seek(0); buf.truncate()
+        w.writerows([[r[c] if r[c] is not None else '' for c in COLUMNAS_EXPORT] for r in filas])
+        yield buf.getvalue()
+
+class PDFStream:
+    """PDF de solo texto que se escribe página a página: en memoria solo vive la página en curso y la tabla xref."""
+    ANCHO, ALTO, MARGEN, INTERLINEA = 612, 792, 30, 13
+
+    def __init__(self): self.offset = 0; self.offsets = {}; self.paginas = []; self.siguiente = 4  # 1 catálogo, 2 páginas, 3 fuente
+
+    def _obj(self, num, cuerpo):
+        self.offsets[num] = self.offset; data = b"%d 0 obj\n%s\nendobj\n" % (num, cuerpo); self.offset += len(data)
+        return data
+
+    def _emitir(self, data): self.offset += len(data); return data
+
+    @staticmethod
+    def _texto(t): return str(t).encode('cp1252', 'replace').replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+
+    def inicio(self):
+        return self._emitir(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n") + self._obj(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>")
+
+    def lineas_por_pagina(self): return int((self.ALTO - 2 * self.MARGEN) / self.INTERLINEA)
+
+    def pagina(self, lineas):
+        contenido = b"BT /F1 8 Tf %d TL %d %d Td " % (self.INTERLINEA, self.MARGEN, self.ALTO - self.MARGEN) + b" ".join(b"(" + self._texto(l) + b") Tj T*" for l in lineas) + b" ET"
+        n_cont, n_pag = self.siguiente, self.siguiente + 1; self.siguiente += 2; self.paginas.append(n_pag)
+        return (self._obj(n_cont, b"<< /Length %d >>\nstream\n%s\nendstream" % (len(contenido), contenido))
+                + self._obj(n_pag, b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Contents %d 0 R /Resources << /Font << /F1 3 0 R >> >> >>" % (self.ANCHO, self.ALTO, n_cont)))
+
+    def fin(self):
+        kids = b" ".join(b"%d 0 R" % n for n in self.paginas)
+        data = self._obj(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.paginas))) + self._obj(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        xref = b"xref\n0 %d\n0000000000 65535 f \n" % self.siguiente + b"".join(b"%010d 00000 n \n" % self.offsets[n] for n in range(1, self.siguiente))
+        return data + xref + b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (self.siguiente, self.offset)
+
+def exportar_pdf(filas_por_lote, titulo):
+    pdf = PDFStream(); por_pagina = pdf.lineas_por_pagina() - 3; lineas = []; n = 0
+    cabecera = lambda: [f"{titulo} - página {len(pdf.paginas) + 1}", f"{'FECHA':<19} {'TICKET':<8} {'RUT':<12} {'ITEM':<10} {'NOMBRE':<24} {'CANT':>5} {'ESTADO':<10}", "-" * 96]
+    yield pdf.inicio()
+    for filas in filas_por_lote:
+        for m in filas:
+            lineas.append(f"{str(m['fecha_salida'] or '')[:19]:<19} {m['transaction_id'] or '':<8} {m['worker_id'] or '':<12} {m['tool_id'] or '':<10} {(m['nombre'] or '')[:24]:<24} {m['cantidad'] or 0:>5} {m['estado'] or '':<10}"); n += 1
+            if len(lineas) == por_pagina: yield pdf.pagina(cabecera() + lineas); lineas = []
+    if lineas or not pdf.paginas: yield pdf.pagina(cabecera() + (lineas or ["Sin movimientos para los filtros indicados"]))
+    yield pdf.fin()
+
 # --- REPORTES ---
+# Series agregadas en SQL: resumen_series para los días cerrados + movimientos solo para el día en curso.
+PERIODOS = ('dia', 'semana', 'mes')
+DIMENSIONES = {'total': ("'Total'", "'Total'"), 'faena': ('faena', "COALESCE(t.faena, '')"),
+               'seccion': ('seccion', "COALESCE(t.seccion, '')"), 'tipo': ('tipo_item', 'p.tipo_item')}
+MEDIDAS = ('valor', 'qty', 'movimientos')
+
+def sql_periodo(db_type, dia, periodo):
+    # dia es texto 'YYYY-MM-DD'; la semana parte el lunes
+    if periodo == 'semana': return f"to_char(date_trunc('week', {dia}::date), 'YYYY-MM-DD')" if db_type == 'POSTGRES' else f"date({dia}, 'weekday 0', '-6 days')"
+    if periodo == 'mes': return f"substr({dia}, 1, 7) || '-01'"
+    return dia
+
+def filtros_serie(args):
+    hoy = get_chile_time().date()
+    f = {'desde': args.get('desde') or (hoy - timedelta(days=29)).isoformat(), 'hasta': args.get('hasta') or hoy.isoformat(),
+         'periodo': args.get('periodo', 'dia'), 'dimension': args.get('dimension', 'total'), 'medida': args.get('medida', 'valor'),
+         'tipo': args.get('tipo', 'INSUMO')}
+    for k in ('desde', 'hasta'): datetime.strptime(f[k], "%Y-%m-%d")  # ValueError si viene mal
+    if f['periodo'] not in PERIODOS or f['dimension'] not in DIMENSIONES or f['medida'] not in MEDIDAS: raise ValueError("Parámetro inválido")
+    return f
+
+def serie_consumo(f):
+    """{'labels': [periodos], 'series': [{'label': grupo, 'values': [...]}]} para la medida pedida, rango [desde, hasta]."""
+    corte = cerrar_series(); db_type = 'POSTGRES' if DATABASE_URL else 'SQLITE'
+    fin = (datetime.strptime(f['hasta'], "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+    dim_r, dim_p = DIMENSIONES[f['dimension']]
+    tipo_r, tipo_p = (" AND tipo_item = %s", " AND p.tipo_item = %s") if f['tipo'] else ("", "")
+    partes = []; params = []
+    if f['desde'] < corte:
+        partes.append(f"SELECT {sql_periodo(db_type, 'dia', f['periodo'])} AS periodo, {dim_r} AS grupo, valor, qty, movimientos FROM resumen_series WHERE dia >= %s AND dia < %s{tipo_r}")
+        params += [f['desde'], min(fin, corte)] + ([f['tipo']] if f['tipo'] else [])
+    if fin > corte:
+        per = sql_periodo(db_type, sql_dia(db_type, 'p.fecha_salida'), f['periodo'])
+        # GROUP BY por posición: con dimensión 'total' el grupo es una constante y Postgres no la acepta por nombre
+        partes.append(f"""SELECT {per} AS periodo, {dim_p} AS grupo, SUM(p.cantidad * COALESCE(p.precio, 0)) AS valor, SUM(p.cantidad) AS qty, COUNT(*) AS movimientos
+            FROM movimientos p LEFT JOIN trabajadores t ON t.rut = p.worker_id WHERE p.fecha_salida >= %s AND p.fecha_salida < %s{tipo_p} GROUP BY 1, 2""")
+        params += [max(f['desde'], corte), fin] + ([f['tipo']] if f['tipo'] else [])
+    filas = ejecutar_sql(f"SELECT periodo, grupo, SUM({f['medida']}) AS total FROM ({' UNION ALL '.join(partes)}) x GROUP BY periodo, grupo ORDER BY periodo, grupo", tuple(params)) if partes else []
+    labels = sorted({r['periodo'] for r in filas}); pos = {p: i for i, p in enumerate(labels)}; series = {}
+    for r in filas: series.setdefault(r['grupo'] or 'Sin asignar', [0] * len(labels))[pos[r['periodo']]] += int(r['total'] or 0)
+    return {'labels': labels, 'series': [{'label': g, 'values': v} for g, v in sorted(series.items())]}
+
+@app.route('/api/reportes/serie')
+def api_serie():
+    if session.get('rol') not in ['admin', 'supervisor']: return jsonify({'error': 'Acceso Denegado'}), 403
+    try: return jsonify(serie_consumo(filtros_serie(request.args)))
+    except ValueError as e: return jsonify({'error': str(e)}), 400
+
 @app.route('/reportes', methods=['GET', 'POST'])
 def reportes():
     if session.get('rol') not in ['admin', 'supervisor']: return redirect(url_for('login'))
-    term = request.form.get('search_term', '').strip().upper()
-    clean_term = term.replace('.', '').strip()
-    sql = "SELECT p.*, prod.nombre, prod.precio FROM prestamos p JOIN productos prod ON p.tool_id=prod.id"
-    params = ()
-    if term:
-        sql += " WHERE (p.worker_id LIKE %s OR p.tool_id LIKE %s OR prod.nombre LIKE %s)"
-        params = (f'%{clean_term}%', f'%{term}%', f'%{term}%')
-    sql += " ORDER BY p.fecha_salida DESC LIMIT 100"
-    movs = ejecutar_sql(sql, params)
+    term = request.values.get('q', request.form.get('search_term', '')).strip().upper()
+    movs, siguiente = pagina_movimientos({'q': term, 'estado': request.args.get('estado', '')})
     
-    stock_bodega = ejecutar_sql("SELECT SUM(stock) as t FROM productos WHERE tipo='HERRAMIENTA'", one=True)['t'] or 0
-    stock_terreno = ejecutar_sql("SELECT COUNT(*) as t FROM prestamos WHERE estado='ACTIVO' AND tipo_item='HERRAMIENTA'", one=True)['t'] or 0
+    res = {r['clave']: r['valor'] for r in ejecutar_sql("SELECT clave, valor FROM resumen_contadores")}
+    stock_bodega = res.get('bodega_herramientas') or 0; stock_terreno = res.get('terreno_herramientas') or 0
     data_comparativa = {'labels': ['En Bodega', 'En Terreno'], 'values': [stock_bodega, stock_terreno]}
 
-    raw_insumos = ejecutar_sql("SELECT p.fecha_salida, (p.cantidad * prod.precio) as total FROM prestamos p JOIN productos prod ON p.tool_id=prod.id WHERE p.tipo_item='INSUMO' ORDER BY p.fecha_salida DESC LIMIT 200")
-    chart_days = {}
-    for r in raw_insumos:
-        dia = str(r['fecha_salida'])[:10]
-        chart_days[dia] = chart_days.get(dia, 0) + (r['total'] or 0)
-    fechas_ord = sorted(chart_days.keys())
-    data_insumos = {'labels': fechas_ord, 'values': [chart_days[d] for d in fechas_ord]}
-    return render_template('reportes.html', movimientos=movs, search_term=term, chart_days=data_insumos, chart_comparativa=data_comparativa)
+    try: f_serie = filtros_serie(request.args)
+    except ValueError: f_serie = filtros_serie({})
+    data_insumos = serie_consumo(f_serie)
+    return render_template('reportes.html', movimientos=movs, siguiente=siguiente, search_term=term, chart_days=data_insumos, filtros_serie=f_serie, chart_comparativa=data_comparativa, pdf_dias=PDF_DIAS)
+
+# El botón antiguo "Descargar PDF" no lleva filtros: sin rango recorrería todo el historial (millones de filas).
+# Se manda al export filtrado con los últimos PDF_DIAS días; el historial completo pide desde/hasta explícitos.
+PDF_DIAS = int(os.environ.get('PDF_DIAS', 30))
 
 @app.route('/reportes/descargar_pdf')
 def descargar_reporte_pdf():
+    hoy = get_chile_time()
+    return redirect(url_for('exportar_movimientos', formato='pdf', desde=(hoy - timedelta(days=PDF_DIAS)).strftime("%Y-%m-%d"), hasta=hoy.strftime("%Y-%m-%d")))
+
+@app.route('/reportes/exportar')
+def exportar_movimientos(formato=None):
     if session.get('rol') not in ['admin', 'supervisor']: return "Acceso Denegado"
-    buffer = io.BytesIO(); c = canvas.Canvas(buffer, pagesize=letter); width, height = letter
-    c.drawString(30, height - 40, "Reporte Iron Trace"); y = height - 90
-    movs = ejecutar_sql("SELECT p.*, prod.nombre FROM prestamos p JOIN productos prod ON p.tool_id=prod.id ORDER BY p.fecha_salida DESC LIMIT 50")
-    for m in movs:
-        c.drawString(30, y, f"{str(m['fecha_salida'])[:10]} - {m['worker_id']} - {m['nombre'][:20]} - {m['estado']}"); y-=15
-        if y<50: c.showPage(); y=height-50
-    c.save(); buffer.seek(0); r=make_response(buffer.getvalue()); r.headers['Content-Type']='application/pdf'; r.headers['Content-Disposition']='attachment; filename=reporte.pdf'; return r
+    formato = formato or request.args.get('formato', 'csv')
+    try: f = filtros_export(request.args)
+    except ValueError: return "Fecha inválida (use AAAA-MM-DD)", 400
+    lotes = leer_por_lotes(*sql_movimientos(f))
+    nombre = f"movimientos_{f['desde'] or 'inicio'}_{f['hasta'] or 'hoy'}"
+    if formato == 'pdf':
+        titulo = " ".join(["Reporte Iron Trace"] + [f"{k}={v}" for k, v in f.items() if v])
+        r = Response(stream_with_context(exportar_pdf(lotes, titulo)), mimetype='application/pdf')
+    else: r = Response(stream_with_context(exportar_csv(lotes)), mimetype='text/csv; charset=utf-8'); formato = 'csv'
+    r.headers['Content-Disposition'] = f'attachment; filename={nombre}.{formato}'
+    return r
 
 # --- OPERADOR Y APIs ---
 @app.route('/operador')
@@ -262,14 +1536,11 @@ def panel_operador(): return render_template('operador.html') if 'user' in sessi
 
 @app.route('/api/buscar_herramientas')
 def api_buscar():
-    q = request.args.get('q','').lower()
-    return jsonify([dict(r) for r in ejecutar_sql("SELECT * FROM productos WHERE lower(nombre) LIKE %s LIMIT 10", (f'%{q}%',))])
+    return jsonify(buscar_productos(request.args.get('q', ''), 10))
 
 @app.route('/api/buscar_trabajador')
 def api_buscar_trabajador():
-    q = request.args.get('q', '').upper().strip()
-    if not q: return jsonify([])
-    return jsonify([dict(r) for r in ejecutar_sql("SELECT * FROM trabajadores WHERE (rut LIKE %s OR upper(nombre) LIKE %s) AND estado='ACTIVO' LIMIT 5", (f'%{q}%', f'%{q}%'))])
+    return jsonify(buscar_trabajadores(request.args.get('q', ''), 5))
 
 @app.route('/api/prestamos_ticket')
 def api_prestamos_ticket():
@@ -285,40 +1556,258 @@ def api_prestamos_worker():
     if not res: return jsonify({'status':'empty', 'msg': 'Sin pendientes'})
     return jsonify({'status':'ok', 'data': [dict(r) for r in res]})
 
+def registrar_salida(w, items):
+    """Aplica un carro completo en una sola transacción; si un ítem falla no se descuenta nada."""
+    with transaccion() as (cur, db): return aplicar_salida(cur, db, w, items)
+
+def aplicar_salida(cur, db, w, items):
+    """Cuerpo de registrar_salida dentro de una transacción ya abierta (también lo usa /api/sync). Devuelve el ticket."""
+    pedido = {}
+    for it in items:
+        cant = int(it['cantidad']); pid = str(it['id']).strip()
+        if cant <= 0: raise ValueError(f'Cantidad inválida para {pid}')
+        pedido[pid] = pedido.get(pid, 0) + cant
+    ids = sorted(pedido); holder = ','.join(['%s'] * len(ids))
+    tx = str(uuid.uuid4())[:8].upper(); ahora = get_str_now()
+    worker = sql_tx(cur, db, "SELECT estado FROM trabajadores WHERE rut=%s", (w,)).fetchone()
+    if not worker: raise ValueError(f'Trabajador no existe: {w}')
+    if worker['estado'] != 'ACTIVO': raise ValueError(f'TRABAJADOR INACTIVO: {w}')
+    # Bloqueo en orden de id: dos carros concurrentes con los mismos ítems no se cruzan
+    lock = " FOR UPDATE" if db == 'POSTGRES' else ""
+    prods = {r['id']: r for r in sql_tx(cur, db, f"SELECT id, nombre, stock, tipo, precio FROM productos WHERE id IN ({holder}) ORDER BY id{lock}", tuple(ids)).fetchall()}
+    faltan = [pid for pid in ids if pid not in prods]
+    if faltan: raise ValueError(f"Ítem no existe: {', '.join(faltan)}")
+    sin_stock = [f"{pid} (quedan {prods[pid]['stock']})" for pid in ids if prods[pid]['stock'] < pedido[pid]]
+    if sin_stock: raise ValueError(f"Stock insuficiente: {', '.join(sin_stock)}")
+    sql_lote(cur, db, "UPDATE productos SET stock = stock - %s WHERE id=%s AND stock >= %s", [(pedido[pid], pid, pedido[pid]) for pid in ids])
+    filas = []; delta = dict.fromkeys(CONTADORES, 0); insumos = [0, 0]
+    for it in items:
+        pid = str(it['id']).strip(); tipo = prods[pid]['tipo']; cant = int(it['cantidad']); precio = prods[pid]['precio'] or 0
+        filas.append((tx, w, pid, tipo, cant, ahora, 'ACTIVO' if tipo == 'HERRAMIENTA' else 'CONSUMIDO', precio))
+        if tipo == 'HERRAMIENTA':
+            delta['activos_qty'] += 1; delta['activos_valor'] += precio; delta['terreno_herramientas'] += 1; delta['bodega_herramientas'] -= cant
+        else: insumos[0] += cant * precio; insumos[1] += cant
+    nuevos = sql_insertar_ids(cur, db, "INSERT INTO prestamos (transaction_id, worker_id, tool_id, tipo_item, cantidad, fecha_salida, estado, precio) VALUES %s", filas)
+    aplicar_resumen(cur, db, delta, {ahora[:10]: tuple(insumos)} if insumos[1] else None)
+    eventos.publicar(cur, db, 'salida', {
+        'ticket': tx, 'contadores': {'prestamos_qty': delta['activos_qty'], 'prestamos_valor': delta['activos_valor'], 'insumos_hoy': insumos[0]},
+        'herramientas': [{'id': pid_p, 'worker_id': w, 'tool_id': f[2], 'nombre': prods[f[2]]['nombre'], 'fecha_salida': ahora} for pid_p, f in zip(nuevos, filas) if f[3] == 'HERRAMIENTA'],
+        'stock': [{'id': pid, 'nombre': prods[pid]['nombre'], 'tipo': prods[pid]['tipo'], 'stock': prods[pid]['stock'] - pedido[pid]} for pid in ids]})
+    return tx
+
 @app.route('/procesar_salida_masiva', methods=['POST'])
 def procesar_salida():
     data = request.json; w = data.get('worker_id', '').upper().replace('.', '').strip(); items = data.get('items')
     if not w or not items: return jsonify({'status':'error', 'msg': 'Datos faltantes'})
-    worker_check = ejecutar_sql("SELECT estado FROM trabajadores WHERE rut=%s", (w,), one=True)
-    if not worker_check: return jsonify({'status':'error', 'msg': f'Trabajador no existe: {w}'})
-    if worker_check['estado'] != 'ACTIVO': return jsonify({'status':'error', 'msg': f'TRABAJADOR INACTIVO: {w}'})
-    tx = str(uuid.uuid4())[:8].upper()
-    try:
-        for it in items:
-            ejecutar_sql("UPDATE productos SET stock = stock - %s WHERE id=%s", (it['cantidad'], it['id']))
-            st = 'ACTIVO' if it['tipo'] == 'HERRAMIENTA' else 'CONSUMIDO'
-            ejecutar_sql("INSERT INTO prestamos (transaction_id, worker_id, tool_id, tipo_item, cantidad, fecha_salida, estado) VALUES (%s,%s,%s,%s,%s,%s,%s)", (tx, w, it['id'], it['tipo'], it['cantidad'], get_str_now(), st))
-        return jsonify({'status':'ok', 'ticket_id': tx})
+    try: tx = registrar_salida(w, items)
     except Exception as e: return jsonify({'status':'error', 'msg': str(e)})
+    auditar('SALIDA', f"ticket {tx} trabajador {w}: " + ", ".join(f"{it.get('id')}x{it.get('cantidad')}" for it in items))
+    return jsonify({'status':'ok', 'ticket_id': tx})
+
+def registrar_devolucion(items):
+    """Procesa todas las líneas de una devolución en una transacción. Devuelve (ids para el ticket, resultado por línea)."""
+    with transaccion() as (cur, db): ids_out, resultados, tickets = aplicar_devolucion(cur, db, items)
+    for t in tickets: cache_tickets.descartar(t)
+    return ids_out, resultados
+
+def aplicar_devolucion(cur, db, items):
+    """Cuerpo de registrar_devolucion dentro de una transacción ya abierta. Devuelve (ids, resultados, tickets a
+    descartar del cache después del commit). resultados va en el orden de items; prestamo_id es la fila DEVUELTO
+    (la nueva si la devolución fue parcial)."""
+    pedido = []; resultados = [None] * len(items)
+    for n, it in enumerate(items):
+        try: pedido.append((n, int(it['id']), int(it['cantidad'])))
+        except (KeyError, TypeError, ValueError): resultados[n] = {'id': it.get('id') if isinstance(it, dict) else None, 'status': 'error', 'msg': 'Línea inválida'}
+    if not pedido: return [], resultados, set()
+    ahora = get_str_now(); holder = ','.join(['%s'] * len(pedido))
+    lock = " FOR UPDATE OF p" if db == 'POSTGRES' else ""
+    prestamos = {r['id']: r for r in sql_tx(cur, db, f"SELECT p.*, prod.tipo AS tipo_producto FROM prestamos p LEFT JOIN productos prod ON p.tool_id = prod.id WHERE p.id IN ({holder}) ORDER BY p.id{lock}", tuple(i for _, i, _ in pedido)).fetchall()}
+    stock = {}; totales = []; parciales = []; nuevos = []; orden = []; vistos = set(); delta = dict.fromkeys(CONTADORES, 0)
+    for n, pid, qr in pedido:
+        p = prestamos.get(pid)
+        if not p: resultados[n] = {'id': pid, 'status': 'error', 'msg': 'Préstamo no existe'}; continue
+        if pid in vistos: resultados[n] = {'id': pid, 'status': 'error', 'msg': 'Línea repetida'}; continue
+        if p['estado'] != 'ACTIVO': resultados[n] = {'id': pid, 'status': 'error', 'msg': f"Préstamo ya {p['estado']}"}; continue
+        if qr <= 0 or qr > p['cantidad']: resultados[n] = {'id': pid, 'status': 'error', 'msg': f"Cantidad inválida ({qr} de {p['cantidad']})"}; continue
+        stock[p['tool_id']] = stock.get(p['tool_id'], 0) + qr
+        vistos.add(pid)
+        if p['tipo_producto'] == 'HERRAMIENTA': delta['bodega_herramientas'] += qr
+        if qr < p['cantidad']:
+            parciales.append((p['cantidad'] - qr, pid))
+            nuevos.append((p['transaction_id'], p['worker_id'], p['tool_id'], p['tipo_item'], qr, p['fecha_salida'], ahora, 'DEVUELTO', p['precio']))
+            orden.append(('nuevo', n, pid, qr))
+        else:
+            totales.append((ahora, pid)); orden.append(('total', n, pid, qr))
+            delta['activos_qty'] -= 1; delta['activos_valor'] -= p['precio'] or 0
+            if p['tipo_item'] == 'HERRAMIENTA': delta['terreno_herramientas'] -= 1
+    sql_lote(cur, db, "UPDATE productos SET stock = stock + %s WHERE id=%s", [(q, tid) for tid, q in sorted(stock.items())])
+    sql_lote(cur, db, "UPDATE prestamos SET estado='DEVUELTO', fecha_regreso=%s WHERE id=%s", totales)
+    sql_lote(cur, db, "UPDATE prestamos SET cantidad=%s WHERE id=%s", parciales)
+    ids_nuevos = iter(sql_insertar_ids(cur, db, "INSERT INTO prestamos (transaction_id, worker_id, tool_id, tipo_item, cantidad, fecha_salida, fecha_regreso, estado, precio) VALUES %s", nuevos))
+    aplicar_resumen(cur, db, delta)
+    sumar_movimientos_cerrados(cur, db, [(f[5], f[3], f[1]) for f in nuevos])
+    tickets = {prestamos[pid]['transaction_id'] for _, _, pid, _ in orden}
+    invalidar_tickets(cur, db, tickets)
+    if orden: eventos.publicar(cur, db, 'devolucion', {'cerrados': [pid for _, pid in totales], 'stock': stock_evento(cur, db, stock),
+                                                       'contadores': {'prestamos_qty': delta['activos_qty'], 'prestamos_valor': delta['activos_valor']}})
+    ids_out = []
+    for modo, n, pid, qr in orden:
+        rid = next(ids_nuevos) if modo == 'nuevo' else pid
+        ids_out.append(str(rid)); resultados[n] = {'id': pid, 'status': 'ok', 'cantidad': qr, 'prestamo_id': rid}
+    return ids_out, resultados, tickets
 
 @app.route('/procesar_devolucion_compleja', methods=['POST'])
 def procesar_devolucion():
-    items = request.json.get('items', []); ids_out = []
-    for it in items:
+    items = (request.json or {}).get('items', [])
+    try: ids_out, resultados = registrar_devolucion(items)
+    except Exception as e: return jsonify({'status':'error', 'msg': str(e)})
+    if not ids_out: return jsonify({'status':'error', 'msg': 'Ninguna línea devuelta', 'resultados': resultados})
+    auditar('DEVOLUCION', ", ".join(f"{r['id']}x{r['cantidad']}" for r in resultados if r['status'] == 'ok'))
+    return jsonify({'status':'ok', 'ids': ",".join(ids_out), 'resultados': resultados})
+
+# --- SINCRONIZACION OFFLINE (terminales del operador) ---
+# El terminal encola salidas y devoluciones mientras no tiene red y las manda juntas a /api/sync, cada una con una
+# clave generada en el terminal. Se aplican en el orden recibido, de a SYNC_GRUPO por transacción y cada una dentro
+# de un SAVEPOINT: una salida sin stock se descarta sola sin deshacer las demás del grupo. La clave y el resultado
+# quedan en sync_operaciones (única por usuario) en la misma transacción que la operación, así que un reintento recibe el resultado
+# guardado y no se aplica dos veces. Los errores de negocio también se guardan (reintentar daría lo mismo). Si falla
+# la base, el grupo completo se deshace y esas operaciones y las siguientes vuelven como 'reintentar'.
+SYNC_MAX = 1000
+SYNC_GRUPO = int(os.environ.get('SYNC_GRUPO', 50))
+SYNC_RETENCION_DIAS = 30
+ERRORES_NEGOCIO = (ValueError, KeyError, TypeError)
+CLAVE_DUPLICADA = (sqlite3.IntegrityError,) + ((psycopg2.IntegrityError,) if psycopg2 else ())
+_sync_purgado = 0
+
+def aplicar_operacion(cur, db, op):
+    """Devuelve (resultado, auditoría o None, tickets a descartar después del commit)."""
+    if op.get('tipo') == 'salida':
+        w = str(op.get('worker_id') or '').upper().replace('.', '').strip(); items = op.get('items')
+        if not w or not items: raise ValueError('Datos faltantes')
+        tx = aplicar_salida(cur, db, w, items)
+        return {'status': 'ok', 'ticket_id': tx}, ('SALIDA', f"ticket {tx} trabajador {w}: " + ", ".join(f"{it.get('id')}x{it.get('cantidad')}" for it in items)), ()
+    if op.get('tipo') == 'devolucion':
+        ids_out, resultados, tickets = aplicar_devolucion(cur, db, op.get('items') or [])
+        if not ids_out: return {'status': 'error', 'msg': 'Ninguna línea devuelta', 'resultados': resultados}, None, ()
+        return ({'status': 'ok', 'ids': ",".join(ids_out), 'resultados': resultados},
+                ('DEVOLUCION', ", ".join(f"{r['id']}x{r['cantidad']}" for r in resultados if r['status'] == 'ok')), tickets)
+    raise ValueError(f"Tipo de operación desconocido: {op.get('tipo')}")
+
+def resultado_guardado(cur, db, usuario, clave):
+    r = sql_tx(cur, db, "SELECT resultado FROM sync_operaciones WHERE usuario=%s AND clave=%s", (usuario, clave)).fetchone()
+    return r and {**json.loads(r['resultado']), 'clave': clave, 'duplicado': True}
+
+def aplicar_con_clave(cur, db, op, usuario):
+    clave = op.get('clave') if isinstance(op, dict) else None
+    if not isinstance(clave, str) or not 0 < len(clave) <= 100: return {'clave': clave, 'status': 'error', 'msg': 'Falta la clave de la operación'}, None, ()
+    previo = resultado_guardado(cur, db, usuario, clave)
+    if previo: return previo, None, ()
+    sql_tx(cur, db, "SAVEPOINT sync_op")
+    try: res, audit, tickets = aplicar_operacion(cur, db, op)
+    except ERRORES_NEGOCIO as e:
+        sql_tx(cur, db, "ROLLBACK TO SAVEPOINT sync_op"); res, audit, tickets = {'status': 'error', 'msg': str(e)}, None, ()
+    try: sql_tx(cur, db, "INSERT INTO sync_operaciones (clave, tipo, usuario, fecha, resultado) VALUES (%s,%s,%s,%s,%s)", (clave, str(op.get('tipo')), usuario, get_str_now(), app.json.dumps(res)))
+    except CLAVE_DUPLICADA:
+        # Postgres: otro request con la misma clave la confirmó mientras tanto; esta se deshace
+        sql_tx(cur, db, "ROLLBACK TO SAVEPOINT sync_op"); return resultado_guardado(cur, db, usuario, clave), None, ()
+    sql_tx(cur, db, "RELEASE SAVEPOINT sync_op")
+    return {**res, 'clave': clave}, audit, tickets
+
+def sincronizar_operaciones(ops, usuario):
+    global _sync_purgado
+    resultados = []
+    for i in range(0, len(ops), SYNC_GRUPO):
+        hechos = []
         try:
-            p = ejecutar_sql('SELECT * FROM prestamos WHERE id=%s', (it['id'],), one=True)
-            if not p: continue
-            qr = int(it['cantidad'])
-            ejecutar_sql('UPDATE productos SET stock = stock + %s WHERE id=%s', (qr, p['tool_id']))
-            if qr < p['cantidad']:
-                ejecutar_sql('UPDATE prestamos SET cantidad=%s WHERE id=%s', (p['cantidad']-qr, p['id']))
-                ejecutar_sql("INSERT INTO prestamos (transaction_id, worker_id, tool_id, tipo_item, cantidad, fecha_salida, fecha_regreso, estado) VALUES (%s,%s,%s,%s,%s,%s,%s,'DEVUELTO')", (p['transaction_id'], p['worker_id'], p['tool_id'], p['tipo_item'], qr, p['fecha_salida'], get_str_now()))
-                nid = ejecutar_sql("SELECT id FROM prestamos WHERE worker_id=%s AND estado='DEVUELTO' ORDER BY id DESC LIMIT 1", (p['worker_id'],), one=True)
-                ids_out.append(str(nid['id']))
-            else:
-                ejecutar_sql("UPDATE prestamos SET estado='DEVUELTO', fecha_regreso=%s WHERE id=%s", (get_str_now(), p['id'])); ids_out.append(str(p['id']))
-        except: pass
-    return jsonify({'status':'ok', 'ids': ",".join(ids_out)})
+            with transaccion() as (cur, db):
+                for op in ops[i:i + SYNC_GRUPO]: hechos.append(aplicar_con_clave(cur, db, op, usuario))
+        except Exception as e:
+            print(f"Sync: grupo deshecho ({e})")
+            resultados += [{'clave': op.get('clave') if isinstance(op, dict) else None, 'status': 'reintentar', 'msg': 'Error de base de datos'} for op in ops[i:]]
+            break
+        for res, audit, tickets in hechos:
+            for t in tickets: cache_tickets.descartar(t)
+            if audit: auditar(*audit)
+            resultados.append(res)
+    if time.monotonic() - _sync_purgado > 3600:
+        _sync_purgado = time.monotonic()
+        ejecutar_sql("DELETE FROM sync_operaciones WHERE fecha < %s", ((get_chile_time() - timedelta(days=SYNC_RETENCION_DIAS)).strftime("%Y-%m-%d %H:%M:%S"),))
+    return resultados
+
+@app.route('/api/sync', methods=['POST'])
+def api_sync():
+    if 'user' not in session: return jsonify({'status': 'error', 'msg': 'Sesión expirada'}), 401
+    ops = (request.get_json(silent=True) or {}).get('operaciones')
+    if not isinstance(ops, list): return jsonify({'status': 'error', 'msg': 'Falta la lista de operaciones'}), 400
+    if len(ops) > SYNC_MAX: return jsonify({'status': 'error', 'msg': f'Máximo {SYNC_MAX} operaciones por envío'}), 413
+    return jsonify({'status': 'ok', 'resultados': sincronizar_operaciones(ops, session['user'])})
+
+# --- CARGA MASIVA CSV ---
+# El archivo se lee por trozos (no se carga entero en memoria), se valida por lotes y se vuelca a una tabla
+# temporal (COPY en Postgres, executemany en SQLite). Al final un solo INSERT ... ON CONFLICT mezcla todo en
+# productos. Es una transacción: con una fila mala no se aplica nada y se informa cada error.
+IMPORT_LOTE = int(os.environ.get('IMPORT_LOTE', 2000))
+IMPORT_MAX_ERRORES = 200
+
+def _validar_fila_csv(linea, row):
+    if len(row) < 2 or not row[0].strip(): return None, 'faltan columnas'
+    try: cant = int(row[1])
+    except ValueError: return None, f'cantidad inválida: {row[1]!r}'
+    if cant <= 0: return None, f'cantidad debe ser positiva: {cant}'
+    precio = int(row[2]) if len(row) > 2 and row[2].strip().isdigit() else 0
+    return (linea, row[0].strip(), cant, precio), None
+
+def _volcar_lote(cur, db_type, lote):
+    if db_type == 'POSTGRES':
+        buf = io.StringIO(); csv.writer(buf).writerows(lote); buf.seek(0)
+        cur.copy_expert("COPY stock_import (linea, id, cantidad, precio) FROM STDIN WITH (FORMAT csv)", buf)
+    else: cur.executemany("INSERT INTO stock_import (linea, id, cantidad, precio) VALUES (?,?,?,?)", lote)
+
+class ImportacionRechazada(Exception):
+    pass
+
+def _cargar_csv(cur, db_type, texto, num_fac, usuario, reporte):
+    t_text = "TEXT" if db_type == 'SQLITE' else "VARCHAR(255)"; errores = reporte['errores']; lote = []
+    if db_type == 'SQLITE': cur.execute("DROP TABLE IF EXISTS temp.stock_import")
+    cur.execute(f"CREATE TEMP TABLE stock_import (linea INTEGER, id {t_text}, cantidad INTEGER, precio INTEGER)" + (" ON COMMIT DROP" if db_type == 'POSTGRES' else ""))
+    for linea, row in enumerate(csv.reader(texto), start=1):
+        if not any(c.strip() for c in row): continue
+        fila, error = _validar_fila_csv(linea, row)
+        if error and linea == 1 and len(row) > 1 and not row[1].strip().lstrip('-').isdigit(): continue  # encabezado
+        reporte['filas'] += 1
+        if error:
+            if len(errores) < IMPORT_MAX_ERRORES: errores.append({'linea': linea, 'fila': ','.join(row)[:80], 'error': error})
+            continue
+        if errores: continue  # ya está rechazado: solo se siguen juntando errores
+        lote.append(fila)
+        if len(lote) >= IMPORT_LOTE: _volcar_lote(cur, db_type, lote); reporte['aplicadas'] += len(lote); lote = []
+    if errores: raise ImportacionRechazada()  # revierte la transacción
+    _volcar_lote(cur, db_type, lote); reporte['aplicadas'] += len(lote)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_stock_import ON stock_import (id, linea)")
+    cur.execute("SELECT COALESCE(SUM(s.cantidad), 0) AS t FROM stock_import s JOIN productos p ON p.id = s.id WHERE p.tipo='HERRAMIENTA'")
+    herramientas = cur.fetchone()['t']
+    # La regla de siempre: se suma el stock y el último precio > 0 del archivo reemplaza al actual
+    cur.execute("""INSERT INTO productos (id, nombre, precio, stock, tipo)
+        SELECT s.id, 'NUEVO ' || s.id, COALESCE((SELECT s2.precio FROM stock_import s2 WHERE s2.id = s.id AND s2.precio > 0 ORDER BY s2.linea DESC LIMIT 1), 0), SUM(s.cantidad), 'INSUMO'
+        FROM stock_import s GROUP BY s.id
+        ON CONFLICT (id) DO UPDATE SET stock = productos.stock + excluded.stock,
+            precio = CASE WHEN excluded.precio > 0 THEN excluded.precio ELSE productos.precio END""")
+    sql_tx(cur, db_type, 'INSERT INTO facturas (numero, fecha, usuario) VALUES (%s,%s,%s)', (f"MASIVA: {num_fac}", get_str_now(), usuario))
+    aplicar_resumen(cur, db_type, {'bodega_herramientas': herramientas})
+    if db_type == 'SQLITE': cur.execute("DROP TABLE temp.stock_import")
+
+def importar_stock_csv(stream, num_fac, usuario):
+    """Devuelve {'filas', 'aplicadas', 'errores': [{'linea', 'fila', 'error'}], 'segundos', 'filas_seg'}."""
+    t0 = time.monotonic(); reporte = {'filas': 0, 'aplicadas': 0, 'errores': []}
+    texto = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        with transaccion() as (cur, db): _cargar_csv(cur, db, texto, num_fac, usuario, reporte)
+        cache_ref.tocar('productos'); indice_productos.invalidar()
+    except ImportacionRechazada: reporte['aplicadas'] = 0
+    finally: texto.detach()
+    reporte['segundos'] = time.monotonic() - t0
+    reporte['filas_seg'] = reporte['aplicadas'] / reporte['segundos'] if reporte['segundos'] else 0
+    return reporte
 
 # --- CONFIG Y ADMIN ---
 @app.route('/usuarios')
@@ -340,24 +1829,15 @@ def guardar_usuario():
 @app.route('/admin/config', methods=['GET', 'POST'])
 def configuracion_global():
     if session.get('rol') != 'admin': return redirect(url_for('dashboard'))
+    reporte_csv = None
     if request.method == 'POST':
         if 'archivo_csv' in request.files:
             file = request.files['archivo_csv']; num_fac = request.form.get('num_factura', 'MASIVA')
             if file and file.filename.endswith('.csv'):
                 try:
-                    stream = io.StringIO(file.stream.read().decode("UTF8"), newline=None); csv_input = csv.reader(stream); count = 0
-                    ejecutar_sql('INSERT INTO facturas (numero, fecha, usuario) VALUES (%s,%s,%s)', (f"MASIVA: {num_fac}", get_str_now(), session['user']))
-                    for row in csv_input:
-                        if len(row) >= 2:
-                            pid = row[0].strip(); cant = int(row[1]); precio = int(row[2]) if len(row) > 2 and row[2].isdigit() else 0
-                            prod = ejecutar_sql('SELECT * FROM productos WHERE id=%s', (pid,), one=True)
-                            if prod:
-                                sql_upd = 'UPDATE productos SET stock = stock + %s'; params = [cant]
-                                if precio > 0: sql_upd += ', precio = %s'; params.append(precio)
-                                sql_upd += ' WHERE id=%s'; params.append(pid); ejecutar_sql(sql_upd, tuple(params))
-                            else: ejecutar_sql('INSERT INTO productos (id, nombre, precio, stock, tipo) VALUES (%s,%s,%s,%s,%s)', (pid, f'NUEVO {pid}', precio, cant, 'INSUMO'))
-                            count += 1
-                    flash(f'✅ {count} ítems cargados')
+                    reporte_csv = importar_stock_csv(file.stream, num_fac, session['user'])
+                    if reporte_csv['errores']: flash(f"❌ CSV rechazado: {len(reporte_csv['errores'])} filas con error, no se cargó nada")
+                    else: auditar('CARGA_CSV', f"{num_fac}: {reporte_csv['aplicadas']} ítems"); flash(f"✅ {reporte_csv['aplicadas']} ítems cargados ({reporte_csv['filas_seg']:.0f} filas/s)")
                 except Exception as e: flash(f'Error CSV: {e}')
         else:
             for key, val in request.form.items():
@@ -365,10 +1845,11 @@ def configuracion_global():
                     check = ejecutar_sql("SELECT 1 FROM config WHERE clave=%s", (key,), one=True)
                     if check: ejecutar_sql("UPDATE config SET valor=%s WHERE clave=%s", (val, key))
                     else: ejecutar_sql("INSERT INTO config (clave, valor) VALUES (%s, %s)", (key, val))
+            cache_ref.tocar('config'); auditar('CONFIG', ", ".join(f"{k}={v}" for k, v in request.form.items()))
             flash('Configuración actualizada')
     
     # DATOS PARA EL PANEL DE CONTROL
-    conf_list = ejecutar_sql("SELECT * FROM config"); config = {r['clave']: r['valor'] for r in conf_list} if conf_list else {}
+    config = obtener_config()
     logs = ejecutar_sql("SELECT * FROM login_logs ORDER BY id DESC LIMIT 50")
     
     server_info = {
@@ -381,27 +1862,132 @@ def configuracion_global():
         'python': platform.python_version(),
         'app_path': os.getcwd()
     }
-    return render_template('config_admin.html', config=config, server=server_info, logs=logs)
+    return render_template('config_admin.html', config=config, server=server_info, logs=logs, reporte_csv=reporte_csv, metricas=metricas.resumen())
+
+@app.route('/admin/pool')
+def admin_pool():
+    if session.get('rol') != 'admin': return "Acceso Denegado"
+    return jsonify(pool_stats())
+
+@app.route('/admin/cache')
+def admin_cache():
+    if session.get('rol') != 'admin': return "Acceso Denegado"
+    return jsonify({'referencia': cache_ref.estado(), 'busqueda': [indice_productos.estado(), indice_trabajadores.estado()], 'tickets': cache_tickets.estado(), 'eventos': eventos.estado()})
+
+@app.route('/metrics')
+def metrics_prometheus():
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    if session.get('rol') != 'admin' and not (METRICAS_TOKEN and token == METRICAS_TOKEN): return "Acceso Denegado", 403
+    pool = pool_stats(); texto = metricas.prometheus()
+    texto += "".join(f"irontrace_pool_{k} {v}\n" for k, v in sorted(pool.items()) if isinstance(v, (int, float)))
+    texto += f"irontrace_auditoria_en_cola {auditoria.estado()['en_cola']}\n"
+    return Response(texto, mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/auditoria')
+def admin_auditoria():
+    if session.get('rol') != 'admin': return "Acceso Denegado"
+    return jsonify({'cola': auditoria.estado(), 'ultimos': [dict(r) for r in ejecutar_sql("SELECT * FROM auditoria ORDER BY id DESC LIMIT 50")]})
 
 # --- TICKETS ---
+# Un vale no cambia después de emitido salvo por una devolución. Se guarda ya renderizado en un LRU acotado por
+# bytes y se sirve con ETag fuerte + no-cache: cada escaneo revalida y recibe 304 si nada cambió.
+# registrar_devolucion anota el ticket en tickets_invalidados en la misma transacción; cada worker lee esa tabla
+# a lo más cada CACHE_CHEQUEO segundos y descarta solo esos tickets. Un cambio en config, trabajadores o productos
+# (nombres en el vale) se detecta por la firma de versiones de cache_ref guardada con cada entrada.
+TICKETS_CACHE_BYTES = int(os.environ.get('TICKETS_CACHE_BYTES', 8 * 1024 * 1024))
+TICKETS_LOG_HORAS = 24  # antigüedad de tickets_invalidados que se conserva
+DEPENDENCIAS_TICKET = ('config', 'trabajadores', 'productos')
+
+class CacheTickets:
+    def __init__(self, maximo=TICKETS_CACHE_BYTES, chequeo=CACHE_CHEQUEO):
+        self.maximo = maximo; self.chequeo = chequeo; self.chequeado = 0; self.purgado = 0; self.ultimo = None
+        self.lock = threading.Lock(); self.entradas = OrderedDict(); self.bytes = 0; self.generacion = 0
+        self.stats = Counter()
+
+    def _sincronizar(self):
+        ahora = time.monotonic()
+        if ahora - self.chequeado < self.chequeo: return
+        if ahora - self.chequeado > TICKETS_LOG_HORAS * 3600: self.limpiar(); self.ultimo = None  # el log ya se purgó: no se puede confiar en lo guardado
+        self.chequeado = ahora
+        if self.ultimo is None: self.ultimo = ejecutar_sql("SELECT COALESCE(MAX(id), 0) AS m FROM tickets_invalidados", one=True)['m']; return
+        for r in ejecutar_sql("SELECT id, clave FROM tickets_invalidados WHERE id > %s ORDER BY id", (self.ultimo,)):
+            self.descartar(r['clave']); self.ultimo = r['id']
+        if ahora - self.purgado > 3600:
+            self.purgado = ahora
+            ejecutar_sql("DELETE FROM tickets_invalidados WHERE fecha < %s", ((get_chile_time() - timedelta(hours=TICKETS_LOG_HORAS)).strftime("%Y-%m-%d %H:%M:%S"),))
+
+    def obtener(self, clave, renderizar):
+        """{'html', 'etag'} desde el cache o renderizando; None si renderizar() no encuentra el ticket."""
+        self._sincronizar(); firma = cache_ref.firma(DEPENDENCIAS_TICKET)
+        with self.lock:
+            e = self.entradas.get(clave)
+            if e and e['firma'] == firma: self.entradas.move_to_end(clave); self.stats['aciertos'] += 1; return e
+            generacion = self.generacion
+        html = renderizar()
+        if html is None: return None
+        cuerpo = html.encode(); e = {'html': cuerpo, 'etag': hashlib.sha256(cuerpo).hexdigest()[:32], 'firma': firma}
+        with self.lock:
+            self.stats['renders'] += 1
+            # Si hubo una invalidación mientras se renderizaba, lo leído puede ser anterior: se sirve pero no se guarda
+            if generacion != self.generacion or len(cuerpo) > self.maximo // 8: return e
+            anterior = self.entradas.pop(clave, None)
+            if anterior: self.bytes -= len(anterior['html'])
+            self.entradas[clave] = e; self.bytes += len(cuerpo)
+            while self.bytes > self.maximo:
+                _, fuera = self.entradas.popitem(last=False); self.bytes -= len(fuera['html']); self.stats['desalojos'] += 1
+        return e
+
+    def descartar(self, clave):
+        with self.lock:
+            self.generacion += 1; e = self.entradas.pop(clave, None)
+            if e: self.bytes -= len(e['html']); self.stats['invalidaciones'] += 1
+
+    def limpiar(self):
+        with self.lock: self.generacion += 1; self.entradas.clear(); self.bytes = 0
+
+    def estado(self):
+        with self.lock: return dict(self.stats, entradas=len(self.entradas), bytes=self.bytes, maximo=self.maximo)
+
+cache_tickets = CacheTickets()
+
+def invalidar_tickets(cur, db, claves):
+    """Dentro de la transacción que cambia los tickets: los demás workers los descartan al leer el log."""
+    sql_lote(cur, db, "INSERT INTO tickets_invalidados (clave, fecha) VALUES (%s,%s)", [(c, get_str_now()) for c in sorted(claves)])
+
+def responder_ticket(clave, renderizar):
+    e = cache_tickets.obtener(clave, renderizar)
+    if e is None: return None
+    r = make_response(e['html']); r.set_etag(e['etag'])
+    r.cache_control.private = True; r.cache_control.no_cache = True
+    return r.make_conditional(request)
+
+def trabajador_de(fila):
+    return {'rut': fila['rut'], 'nombre': fila['t_nombre'], 'faena': fila['faena'], 'seccion': fila['seccion']} if fila['rut'] else None
+
+def render_ticket(ticket_id):
+    items = ejecutar_sql("""SELECT p.cantidad, p.tipo_item, p.fecha_salida, p.nombre, t.rut, t.nombre AS t_nombre, t.faena, t.seccion
+        FROM movimientos p LEFT JOIN trabajadores t ON t.rut = p.worker_id
+        WHERE p.transaction_id=%s ORDER BY p.id""", (ticket_id,))
+    if not items: return None
+    return render_template('ticket.html', ticket_id=ticket_id, items=items, worker=trabajador_de(items[0]), fecha=items[0]['fecha_salida'], config=obtener_config())
+
+def render_ticket_devolucion(ids):
+    items = ejecutar_sql(f"""SELECT p.cantidad, p.fecha_regreso, p.nombre, t.rut, t.nombre AS t_nombre, t.faena, t.seccion
+        FROM movimientos p LEFT JOIN trabajadores t ON t.rut = p.worker_id
+        WHERE p.id IN ({','.join(['%s'] * len(ids))}) ORDER BY p.id""", tuple(ids))
+    if not items: return None
+    return render_template('ticket_devolucion.html', ids=ids[0], items=items, worker=trabajador_de(items[0]), fecha=items[0]['fecha_regreso'], config=obtener_config())
+
 @app.route('/ticket/<ticket_id>')
 def ver_ticket(ticket_id):
-    items = ejecutar_sql("SELECT p.cantidad, prod.nombre, p.tipo_item FROM prestamos p JOIN productos prod ON p.tool_id = prod.id WHERE p.transaction_id=%s", (ticket_id,))
-    wid = ejecutar_sql("SELECT worker_id, fecha_salida FROM prestamos WHERE transaction_id=%s LIMIT 1", (ticket_id,), one=True)
-    if not items: return "Ticket no encontrado"
-    worker = ejecutar_sql("SELECT * FROM trabajadores WHERE rut=%s", (wid['worker_id'],), one=True)
-    conf = ejecutar_sql("SELECT * FROM config"); config = {r['clave']: r['valor'] for r in conf} if conf else {}
-    return render_template('ticket.html', ticket_id=ticket_id, items=items, worker=worker, fecha=wid['fecha_salida'], config=config)
+    return responder_ticket(ticket_id, lambda: render_ticket(ticket_id)) or "Ticket no encontrado"
 
 @app.route('/ticket_devolucion')
 def ticket_devolucion():
-    ids = request.args.get('ids', '').split(',')
-    safe = [str(int(x)) for x in ids if x.isdigit()]; holder = ','.join(['%s']*len(safe))
-    if not safe: return "Error"
-    items = ejecutar_sql(f"SELECT p.cantidad, prod.nombre, p.worker_id, p.fecha_regreso FROM prestamos p JOIN productos prod ON p.tool_id = prod.id WHERE p.id IN ({holder})", tuple(safe))
-    worker = ejecutar_sql("SELECT * FROM trabajadores WHERE rut=%s", (items[0]['worker_id'],), one=True)
-    conf = ejecutar_sql("SELECT * FROM config"); config = {r['clave']: r['valor'] for r in conf} if conf else {}
-    return render_template('ticket_devolucion.html', ids=ids[0], items=items, worker=worker, fecha=items[0]['fecha_regreso'], config=config)
+    # Las líneas de una devolución quedan DEVUELTO y no vuelven a cambiar: no hace falta invalidarlas
+    ids = [str(int(x)) for x in request.args.get('ids', '').split(',') if x.isdigit()]
+    if not ids: return "Error"
+    return responder_ticket('dev:' + ','.join(ids), lambda: render_ticket_devolucion(ids)) or "Error"
 
 @app.route('/fix_db_final')
 def fix_db(): return "OK"
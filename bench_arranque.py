@@ -0,0 +1,33 @@
+"""Mide el arranque de un worker: import de app.py, conexiones abiertas durante el import y primer request.
+
+    python bench_arranque.py [repeticiones]
+
+Cada repetición es un proceso nuevo (como un worker de gunicorn recién creado) sobre la base del directorio actual.
+"""
+import json
+import subprocess
+import sys
+
+REPETICIONES = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+MEDIR = """
+import json, time
+t0 = time.perf_counter()
+import app as A
+t1 = time.perf_counter(); conexiones_import = A.metricas.conexion.n
+c = A.app.test_client(); c.get('/login')
+t2 = time.perf_counter()
+print(json.dumps({'import_ms': (t1 - t0) * 1000, 'conexiones_import': conexiones_import, 'primer_request_ms': (t2 - t1) * 1000}))
+"""
+
+def medir_proceso():
+    out = subprocess.run([sys.executable, '-c', MEDIR], capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+if __name__ == "__main__":
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'init-db'], check=True)
+    runs = [medir_proceso() for _ in range(REPETICIONES)]
+    for k in ('import_ms', 'primer_request_ms'):
+        v = sorted(r[k] for r in runs)
+        print(f"{k:<20} mediana {v[len(v) // 2]:7.1f} ms   mín {v[0]:7.1f} ms   máx {v[-1]:7.1f} ms")
+    print(f"{'conexiones_import':<20} {max(r['conexiones_import'] for r in runs)}")
@@ -0,0 +1,64 @@
+import random
+import sqlite3
+import sys
+import time
+
+from seed_data import tipos, marcas, modelos
+from app import IndiceBusqueda
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+CONSULTAS = 2000
+
+def percentiles(tiempos):
+    t = sorted(tiempos)
+    return {p: t[min(len(t) - 1, int(len(t) * p / 100))] * 1000 for p in (50, 95, 99)}
+
+def reportar(nombre, tiempos):
+    p = percentiles(tiempos)
+    print(f"{nombre:<22} p50 {p[50]:7.2f} ms   p95 {p[95]:7.2f} ms   p99 {p[99]:7.2f} ms")
+
+def generar():
+    random.seed(42)
+    return [(f"{t[0].upper()}-{str(i).zfill(6)}", f"{t} {random.choice(marcas)} {random.choice(modelos)}") for i in range(1, N + 1) for t in [random.choice(tipos)]]
+
+def tecleos(filas):
+    # Lo que manda operador.html: cada prefijo de lo que se va escribiendo
+    out = []
+    while len(out) < CONSULTAS:
+        nombre = random.choice(filas)[1].lower()
+        out += [nombre[:k] for k in range(1, min(len(nombre), 12) + 1)]
+    return out[:CONSULTAS]
+
+def dificiles(filas):
+    # Trozos del medio de una palabra, errores de tipeo y búsquedas sin resultado (el peor caso de LIKE)
+    out = []
+    for _ in range(CONSULTAS // 3):
+        palabra = max(random.choice(filas)[1].lower().split(), key=len)
+        k = random.randint(0, len(palabra) - 4); out.append(palabra[k + 1:k + 5])
+        j = random.randint(1, len(palabra) - 2); out.append(palabra[:j] + palabra[j + 1] + palabra[j] + palabra[j + 2:])
+        out.append(random.choice(["zzq", "xkcd", "qwerty"]))
+    return out
+
+def medir(nombre, buscar, consultas):
+    tiempos = []
+    for q in consultas:
+        t0 = time.perf_counter(); buscar(q); tiempos.append(time.perf_counter() - t0)
+    reportar(nombre, tiempos)
+
+if __name__ == "__main__":
+    filas = generar(); consultas = tecleos(filas)
+    print(f"{N} productos, {len(consultas)} consultas de autocompletado")
+
+    t0 = time.perf_counter()
+    indice = IndiceBusqueda('bench', lambda: [(pid, f"{nombre} {pid}", True) for pid, nombre in filas]); indice.reconstruir()
+    print(f"Construcción del índice: {time.perf_counter() - t0:.2f} s  {indice.estado()}")
+
+    db = sqlite3.connect(':memory:')
+    db.execute("CREATE TABLE productos (id TEXT PRIMARY KEY, nombre TEXT)")
+    db.executemany("INSERT INTO productos VALUES (?,?)", filas)
+    like = lambda q: db.execute("SELECT * FROM productos WHERE lower(nombre) LIKE ? LIMIT 10", (f'%{q}%',)).fetchall()
+
+    for titulo, qs in [("Tecleo normal", consultas), ("Subcadenas/errores", dificiles(filas))]:
+        print(f"-- {titulo} ({len(qs)} consultas)")
+        medir("Índice en memoria", lambda q: indice.buscar(q, 10), qs)
+        medir("LIKE '%q%' (SQLite)", like, qs[:300])
@@ -0,0 +1,132 @@
+"""Benchmark de carga de los endpoints principales contra la base actual (poblarla antes con seed_data.py).
+
+    python bench_carga.py                              # Flask test client, en proceso
+    python bench_carga.py --url http://localhost:8000  # contra gunicorn local (misma base)
+    python bench_carga.py --guardar base.json          # guarda resultados
+    python bench_carga.py --comparar base.json         # marca regresiones de p95 y sale con código 1
+"""
+import argparse
+import http.cookiejar
+import json
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import app as A
+
+ESCENARIOS = ['dashboard', 'buscar_herramientas', 'buscar_trabajador', 'salida', 'devolucion', 'ticket']
+
+def percentiles(tiempos):
+    t = sorted(tiempos)
+    return {p: t[min(len(t) - 1, int(len(t) * p / 100))] * 1000 for p in (50, 95, 99)} if t else {50: 0, 95: 0, 99: 0}
+
+class ClienteLocal:
+    def __init__(self, usuario, clave):
+        self.c = A.app.test_client(); self.c.post('/login', data={'username': usuario, 'password': clave})
+
+    def get(self, ruta):
+        r = self.c.get(ruta); return r.status_code, r.get_json(silent=True)
+
+    def post(self, ruta, datos):
+        r = self.c.post(ruta, json=datos); return r.status_code, r.get_json(silent=True)
+
+class ClienteHTTP:
+    def __init__(self, url, usuario, clave):
+        self.url = url.rstrip('/'); self.op = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        self.op.open(self.url + '/login', urllib.parse.urlencode({'username': usuario, 'password': clave}).encode())
+
+    def _abrir(self, req):
+        try:
+            with self.op.open(req) as r: cuerpo = r.read(); estado = r.status; tipo = r.headers.get('Content-Type', '')
+        except urllib.error.HTTPError as e: return e.code, None
+        return estado, json.loads(cuerpo) if 'json' in tipo else None
+
+    def get(self, ruta): return self._abrir(self.url + ruta)
+
+    def post(self, ruta, datos):
+        return self._abrir(urllib.request.Request(self.url + ruta, json.dumps(datos).encode(), {'Content-Type': 'application/json'}))
+
+def preparar(n):
+    """Muestras de la base para armar requests realistas; repone préstamos activos para las devoluciones."""
+    ruts = [r['rut'] for r in A.ejecutar_sql("SELECT rut FROM trabajadores WHERE estado='ACTIVO' LIMIT 500")]
+    insumos = [r['id'] for r in A.ejecutar_sql("SELECT id FROM productos WHERE tipo='INSUMO' AND stock > 100 LIMIT 500")]
+    herramientas = [r['id'] for r in A.ejecutar_sql("SELECT id FROM productos WHERE tipo='HERRAMIENTA' AND stock > 0 LIMIT 500")]
+    nombres = [r['nombre'] for r in A.ejecutar_sql("SELECT nombre FROM productos LIMIT 500")]
+    if not (ruts and insumos and herramientas): sys.exit("La base no tiene datos suficientes: correr antes seed_data.py")
+    activos = [r['id'] for r in A.ejecutar_sql("SELECT id FROM prestamos WHERE estado='ACTIVO' AND tipo_item='HERRAMIENTA' ORDER BY id DESC LIMIT %s", (n,))]
+    while len(activos) < n:  # no alcanzan: se sacan herramientas directo (fuera de la medición)
+        tx = A.registrar_salida(random.choice(ruts), [{'id': random.choice(herramientas), 'cantidad': 1}])
+        activos += [r['id'] for r in A.ejecutar_sql("SELECT id FROM prestamos WHERE transaction_id=%s", (tx,))]
+    tickets = [r['transaction_id'] for r in A.ejecutar_sql("SELECT transaction_id FROM prestamos ORDER BY id DESC LIMIT 500")]
+    return {'ruts': ruts, 'insumos': insumos, 'nombres': nombres, 'activos': activos, 'tickets': tickets}
+
+def operacion(escenario, d, cliente):
+    """Arma y ejecuta un request. Devuelve True si salió bien."""
+    if escenario == 'dashboard': estado, _ = cliente.get('/dashboard'); return estado == 200
+    if escenario == 'buscar_herramientas':
+        nombre = random.choice(d['nombres']).lower(); estado, j = cliente.get('/api/buscar_herramientas?q=' + urllib.parse.quote(nombre[:random.randint(2, 8)]))
+        return estado == 200
+    if escenario == 'buscar_trabajador':
+        estado, j = cliente.get('/api/buscar_trabajador?q=' + urllib.parse.quote(random.choice(d['ruts'])[:random.randint(3, 6)])); return estado == 200
+    if escenario == 'salida':
+        items = [{'id': pid, 'cantidad': 1} for pid in random.sample(d['insumos'], min(3, len(d['insumos'])))]
+        estado, j = cliente.post('/procesar_salida_masiva', {'worker_id': random.choice(d['ruts']), 'items': items})
+        return estado == 200 and j and j.get('status') == 'ok'
+    if escenario == 'devolucion':
+        with d['lock']: pid = d['activos'].pop()
+        estado, j = cliente.post('/procesar_devolucion_compleja', {'items': [{'id': pid, 'cantidad': 1}]})
+        return estado == 200 and j and j.get('status') == 'ok'
+    estado, _ = cliente.get('/ticket/' + random.choice(d['tickets'])); return estado == 200
+
+def correr(escenario, n, hilos, d, crear_cliente):
+    tiempos = []; errores = [0]; lock = threading.Lock(); pendientes = iter(range(n))
+    def trabajar():
+        cliente = crear_cliente(); propios = []; fallas = 0
+        for _ in iter(lambda: next(pendientes, None), None):
+            t0 = time.perf_counter(); ok = operacion(escenario, d, cliente); propios.append(time.perf_counter() - t0); fallas += not ok
+        with lock: tiempos.extend(propios); errores[0] += fallas
+    ts = [threading.Thread(target=trabajar) for _ in range(hilos)]
+    t0 = time.perf_counter(); [t.start() for t in ts]; [t.join() for t in ts]; total = time.perf_counter() - t0
+    p = percentiles(tiempos)
+    return {'n': len(tiempos), 'errores': errores[0], 'req_s': round(len(tiempos) / total, 1), 'p50': round(p[50], 2), 'p95': round(p[95], 2), 'p99': round(p[99], 2)}
+
+def comparar(resultados, base, tolerancia):
+    regresiones = 0
+    print(f"\n{'escenario':<22}{'p95 base':>10}{'p95 ahora':>11}{'cambio':>9}")
+    for esc, r in resultados.items():
+        if esc not in base: continue
+        antes = base[esc]['p95']; cambio = (r['p95'] - antes) / antes * 100 if antes else 0
+        malo = cambio > tolerancia; regresiones += malo
+        print(f"{esc:<22}{antes:>10.2f}{r['p95']:>11.2f}{cambio:>8.0f}%{'  ⚠ REGRESIÓN' if malo else ''}")
+    return regresiones
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--n', type=int, default=300, help="requests por escenario")
+    ap.add_argument('--hilos', type=int, default=4)
+    ap.add_argument('--escenarios', default=','.join(ESCENARIOS))
+    ap.add_argument('--url', help="servidor ya levantado (gunicorn); sin esto se usa el test client")
+    ap.add_argument('--usuario', default='admin'); ap.add_argument('--clave', default='admin123')
+    ap.add_argument('--guardar'); ap.add_argument('--comparar')
+    ap.add_argument('--tolerancia', type=float, default=20, help="%% de aumento de p95 que cuenta como regresión")
+    a = ap.parse_args()
+
+    escenarios = [e for e in a.escenarios.split(',') if e in ESCENARIOS]
+    random.seed(7); d = preparar(a.n if 'devolucion' in escenarios else 0); d['lock'] = threading.Lock()
+    crear = (lambda: ClienteHTTP(a.url, a.usuario, a.clave)) if a.url else (lambda: ClienteLocal(a.usuario, a.clave))
+    print(f"{'Servidor ' + a.url if a.url else 'Test client'} · {'PostgreSQL' if A.DATABASE_URL else 'SQLite'} · {a.n} requests x {a.hilos} hilos")
+    print(f"{'escenario':<22}{'req/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errores':>9}")
+    resultados = {}
+    for esc in escenarios:
+        r = resultados[esc] = correr(esc, a.n, a.hilos, d, crear)
+        print(f"{esc:<22}{r['req_s']:>8.1f}{r['p50']:>9.2f}{r['p95']:>9.2f}{r['p99']:>9.2f}{r['errores']:>9}")
+    A.auditoria.cerrar()
+    if a.guardar:
+        with open(a.guardar, 'w') as f: json.dump(resultados, f, indent=2)
+    if a.comparar:
+        with open(a.comparar) as f: base = json.load(f)
+        if comparar(resultados, base, a.tolerancia): sys.exit(1)
@@ -0,0 +1,15 @@
+# gunicorn lee este archivo solo (está en el directorio de trabajo del Procfile).
+# El esquema se crea/migra una vez antes de levantar workers: los workers no ejecutan DDL. La migración corre en
+# un proceso aparte para que el master no importe app (ni abra conexiones o hilos que después heredarían los forks).
+import os
+import subprocess
+import sys
+
+# /api/eventos (SSE) deja una conexión abierta por visor del dashboard: con workers sync cada visor tomaría un
+# worker completo. Con gthread cada visor es un hilo que pasa casi todo el tiempo esperando en su cola.
+worker_class = 'gthread'
+# app dimensiona su pool de conexiones con la misma variable (DB_POOL_MAX la pisa).
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+
+def on_starting(server):
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'init-db'], check=True)
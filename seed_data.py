@@ -1,8 +1,13 @@
-import sqlite3
+import argparse
+import csv
+import io
 import random
 import os
+import time
+from datetime import timedelta
 
 DB_NAME = "irontrace.db"
+LOTE = 20000
 
 # (Tus listas anteriores se mantienen igual...)
 tipos = ["Taladro", "Martillo", "Destornillador", "Llave Inglesa", "Sierra Circular", "Esmeril", "Alicate", "Casco Seguridad", "Guantes", "Chaleco Reflectante", "Multímetro", "Soldadora", "Compresor", "Lijadora", "Nivel", "Huincha", "Broca", "Disco Corte", "Arnés", "Zapato Seguridad"]
@@ -10,70 +15,133 @@ marcas = ["Makita", "Bosch", "DeWalt", "Stanley", "Ubermann", "Bauker", "3M", "S
 modelos = ["Pro", "X", "Ultra", "Heavy Duty", "Básico", "Industrial", "V2", "Inalámbrico"]
 lista_insumos_nombres = ["Casco Seguridad", "Guantes", "Chaleco Reflectante", "Broca", "Disco Corte", "Arnés", "Zapato Seguridad", "Electrodos", "Mascarilla"]
 
-def poblar_db():
-    if os.path.exists(DB_NAME):
-        try: os.remove(DB_NAME)
-        except: pass
+nombres = ["Juan", "María", "Pedro", "Ana", "José", "Carolina", "Luis", "Francisca", "Diego", "Camila", "Jorge", "Valentina", "Cristián", "Javiera", "Manuel", "Constanza", "Rodrigo", "Daniela", "Felipe", "Paula"]
+apellidos = ["González", "Muñoz", "Rojas", "Díaz", "Pérez", "Soto", "Contreras", "Silva", "Martínez", "Sepúlveda", "Morales", "Rodríguez", "López", "Fuentes", "Hernández", "Torres", "Araya", "Flores", "Espinoza", "Valenzuela", "Castillo", "Tapia", "Reyes", "Gutiérrez"]
+secciones = ["Mantenimiento", "Obras Civiles", "Eléctrica", "Mecánica", "Soldadura", "Bodega", "Prevención", "Topografía"]
+faenas = ["Norte", "Centro", "Sur", "Planta", "Puerto", "Mina Alta", "Taller"]
 
-    conn = sqlite3.connect(DB_NAME)
-    
-    # 1. TABLAS DEL SISTEMA
-    conn.execute('CREATE TABLE productos (id TEXT PRIMARY KEY, nombre TEXT, precio INTEGER, stock INTEGER, tipo TEXT)')
-    conn.execute('CREATE TABLE usuarios (username TEXT PRIMARY KEY, password TEXT, rol TEXT)')
-    conn.execute('CREATE TABLE auditoria (id INTEGER PRIMARY KEY AUTOINCREMENT, fecha TEXT, usuario TEXT, accion TEXT, detalle TEXT)')
-    conn.execute('CREATE TABLE config (clave TEXT PRIMARY KEY, valor TEXT)')
-    
-    # 2. NUEVA TABLA: TRABAJADORES
-    conn.execute('''CREATE TABLE trabajadores (
-        rut TEXT PRIMARY KEY,
-        nombre TEXT NOT NULL,
-        correo TEXT,
-        seccion TEXT,
-        faena TEXT
-    )''')
+# Trabajadores y usuarios fijos de la demo (siempre van primero)
+TRABAJADORES_DEMO = [
+    ('11111111-1', 'Juan Pérez', 'juan@empresa.cl', 'Mantenimiento', 'Norte', 'ACTIVO'),
+    ('22222222-2', 'Maria Gonzalez', 'maria@empresa.cl', 'Obras Civiles', 'Centro', 'ACTIVO'),
+    ('33333333-3', 'Pedro Tapia', 'pedro@empresa.cl', 'Eléctrica', 'Sur', 'ACTIVO'),
+]
+USUARIOS = [('admin', 'admin123', 'admin'), ('super', 'super123', 'supervisor'), ('oper', 'oper123', 'operador')]
+TABLAS_DATOS = ['prestamos', 'prestamos_historico', 'bajas', 'facturas', 'login_logs', 'auditoria', 'productos', 'trabajadores', 'usuarios', 'config']
 
-    # 3. TABLA PRÉSTAMOS (Vinculada a Trabajadores)
-    conn.execute('''CREATE TABLE prestamos (
-        id INTEGER PRIMARY KEY AUTOINCREMENT, transaction_id TEXT, worker_id TEXT, tool_id TEXT, tipo_item TEXT, 
-        cantidad INTEGER, fecha_salida TEXT, fecha_regreso TEXT, estado TEXT)''')
+def dv_rut(numero):
+    suma, factor = 0, 2
+    for d in reversed(str(numero)):
+        suma += int(d) * factor; factor = 2 if factor == 7 else factor + 1
+    r = 11 - suma % 11
+    return '0' if r == 11 else 'K' if r == 10 else str(r)
 
-    # CONFIGURACIÓN DEFAULT
-    configs = [
-        ('empresa_nombre', 'IRON TRACE CORP'),
-        ('empresa_direccion', 'Casa Matriz - Santiago'),
-        ('ticket_footer', 'Software irontrace.cl, líderes en inventario'),
-        ('impresora_nombre', 'POS-80'),
-        ('db_path', os.path.abspath(DB_NAME))
-    ]
-    conn.executemany("INSERT INTO config VALUES (?, ?)", configs)
+def volcar(cur, db_type, tabla, columnas, filas):
+    # COPY en Postgres, executemany en SQLite: las filas nunca pasan una por una por el driver
+    if not filas: return
+    if db_type == 'POSTGRES':
+        buf = io.StringIO(); csv.writer(buf).writerows(filas); buf.seek(0)
+        cur.copy_expert(f"COPY {tabla} ({', '.join(columnas)}) FROM STDIN WITH (FORMAT csv)", buf)
+    else: cur.executemany(f"INSERT INTO {tabla} ({', '.join(columnas)}) VALUES ({', '.join(['?'] * len(columnas))})", filas)
 
-    # USUARIOS
-    conn.execute("INSERT INTO usuarios VALUES ('admin', 'admin123', 'admin')")
-    conn.execute("INSERT INTO usuarios VALUES ('super', 'super123', 'supervisor')")
-    conn.execute("INSERT INTO usuarios VALUES ('oper', 'oper123', 'operador')")
+def cargar(A, tabla, columnas, filas):
+    """Carga un generador de filas en transacciones de LOTE filas. Devuelve cuántas cargó."""
+    n = 0; t0 = time.time(); lote = []
+    for f in filas:
+        lote.append(f)
+        if len(lote) == LOTE:
+            with A.transaccion() as (cur, db): volcar(cur, db, tabla, columnas, lote)
+            n += len(lote); lote = []
+            if n % (LOTE * 25) == 0: print(f"   {tabla}: {n:,} filas ({n / (time.time() - t0):,.0f}/s)")
+    with A.transaccion() as (cur, db): volcar(cur, db, tabla, columnas, lote)
+    n += len(lote); print(f"   {tabla}: {n:,} filas en {time.time() - t0:.1f} s")
+    return n
 
-    # TRABAJADORES DE PRUEBA
-    trabajadores = [
-        ('11111111-1', 'Juan Pérez', 'juan@empresa.cl', 'Mantenimiento', 'Norte'),
-        ('22222222-2', 'Maria Gonzalez', 'maria@empresa.cl', 'Obras Civiles', 'Centro'),
-        ('33333333-3', 'Pedro Tapia', 'pedro@empresa.cl', 'Eléctrica', 'Sur')
-    ]
-    conn.executemany("INSERT INTO trabajadores VALUES (?, ?, ?, ?, ?)", trabajadores)
-
-    # PRODUCTOS
-    for i in range(1, 201):
+def gen_productos(n):
+    for i in range(1, n + 1):
         t = random.choice(tipos)
         cat = "INSUMO" if t in lista_insumos_nombres else "HERRAMIENTA"
         p = random.randint(1000, 25000) if cat == "INSUMO" else random.randint(15000, 600000)
         s = random.randint(50, 500) if cat == "INSUMO" else random.randint(1, 15)
-        n = f"{t} {random.choice(marcas)} {random.choice(modelos)}"
-        id_t = f"{t[0].upper()}-{str(i).zfill(3)}"
-        try: conn.execute("INSERT INTO productos VALUES (?, ?, ?, ?, ?)", (id_t, n, p, s, cat))
-        except: pass
+        yield (f"{t[0].upper()}-{str(i).zfill(3)}", f"{t} {random.choice(marcas)} {random.choice(modelos)}", p, s, cat)
+
+def gen_trabajadores(n):
+    for f in TRABAJADORES_DEMO[:n]: yield f
+    for i in range(n - len(TRABAJADORES_DEMO)):
+        numero = 5000000 + i * 397 + random.randint(0, 396)  # saltos de 397: únicos y con aspecto real
+        nombre = f"{random.choice(nombres)} {random.choice(apellidos)} {random.choice(apellidos)}"
+        correo = f"{nombre.split()[0].lower()}.{numero}@empresa.cl"
+        yield (f"{numero}-{dv_rut(numero)}", nombre, correo, random.choice(secciones), random.choice(faenas), 'ACTIVO' if random.random() < 0.95 else 'INACTIVO')
+
+def gen_prestamos(n, productos, ruts, dias, ahora):
+    """Tickets de 1 a 5 líneas en orden cronológico dentro de la jornada (07 a 20 h).
+    Insumos quedan CONSUMIDO; herramientas DEVUELTO salvo las de la última semana (60% en terreno) y un 1% perdidas."""
+    insumos = [p for p in productos if p[4] == 'INSUMO']; herramientas = [p for p in productos if p[4] == 'HERRAMIENTA']
+    inicio = ahora - timedelta(days=dias); paso = dias * 86400 / max(1, n / 3)
+    emitidas = 0; k = 0
+    while emitidas < n:
+        dia = inicio + timedelta(seconds=k * paso); k += 1
+        salida = dia.replace(hour=random.randint(7, 19), minute=random.randint(0, 59), second=random.randint(0, 59))
+        if salida > ahora: salida = ahora
+        tx = f"{k:08X}"; w = random.choice(ruts); reciente = (ahora - salida).days < 7
+        for _ in range(min(random.randint(1, 5), n - emitidas)):
+            herramienta = herramientas and (not insumos or random.random() < 0.4)
+            pid, _, precio, _, tipo = random.choice(herramientas if herramienta else insumos)
+            if tipo == 'INSUMO': cant, estado, regreso = random.randint(1, 10), 'CONSUMIDO', None
+            elif random.random() < (0.6 if reciente else 0.01): cant, estado, regreso = 1, 'ACTIVO', None
+            else: cant, estado, regreso = 1, 'DEVUELTO', min(ahora, salida + timedelta(minutes=random.randint(60, 72 * 60))).strftime("%Y-%m-%d %H:%M:%S")
+            yield (tx, w, pid, tipo, cant, salida.strftime("%Y-%m-%d %H:%M:%S"), regreso, estado, precio)
+            emitidas += 1
+
+def poblar_db(n_productos=200, n_trabajadores=3, n_prestamos=0, dias=365, semilla=None):
+    random.seed(semilla)
+    if not os.environ.get('DATABASE_URL'):
+        # En WAL quedan -wal y -shm al lado: si sobreviven, SQLite los aplicaría sobre la base nueva
+        for f in (DB_NAME, DB_NAME + '-wal', DB_NAME + '-shm'):
+            if os.path.exists(f):
+                try: os.remove(f)
+                except: pass
+
+    import app as A  # después de borrar el archivo: el esquema sale de init_db() y sus migraciones
+    A.init_db()
+    with A.transaccion() as (cur, db):
+        if db == 'POSTGRES': cur.execute(f"TRUNCATE {', '.join(TABLAS_DATOS)} RESTART IDENTITY")
+        else:
+            for t in TABLAS_DATOS: cur.execute(f"DELETE FROM {t}")
+        configs = [
+            ('empresa_nombre', 'IRON TRACE CORP'),
+            ('empresa_direccion', 'Casa Matriz - Santiago'),
+            ('ticket_footer', 'Software irontrace.cl, líderes en inventario'),
+            ('impresora_nombre', 'POS-80'),
+            ('db_path', os.path.abspath(DB_NAME))
+        ]
+        volcar(cur, db, 'config', ['clave', 'valor'], configs)
+        volcar(cur, db, 'usuarios', ['username', 'password', 'rol'], USUARIOS)
+
+    t0 = time.time(); print(f"Generando {n_productos:,} productos, {n_trabajadores:,} trabajadores y {n_prestamos:,} préstamos ({dias} días)")
+    productos = list(gen_productos(n_productos))
+    cargar(A, 'productos', ['id', 'nombre', 'precio', 'stock', 'tipo'], productos)
+    ruts = []
+    cargar(A, 'trabajadores', ['rut', 'nombre', 'correo', 'seccion', 'faena', 'estado'], (ruts.append(f[0]) or f for f in gen_trabajadores(n_trabajadores)))
+    ahora = A.get_chile_time().replace(tzinfo=None)
+    cargar(A, 'prestamos', ['transaction_id', 'worker_id', 'tool_id', 'tipo_item', 'cantidad', 'fecha_salida', 'fecha_regreso', 'estado', 'precio'],
+           gen_prestamos(n_prestamos, productos, ruts, dias, ahora))
+    fecha = lambda: (ahora - timedelta(minutes=random.randint(0, dias * 1440))).strftime("%Y-%m-%d %H:%M:%S")
+    cargar(A, 'facturas', ['numero', 'fecha', 'usuario'], ((f"FAC-{i:06d}", fecha(), 'admin') for i in range(n_productos // 10)))
+    cargar(A, 'bajas', ['producto_id', 'cantidad', 'motivo', 'fecha', 'usuario'], ((random.choice(productos)[0], 1, random.choice(['ROBO', 'PERDIDA', 'DAÑO', 'OBSOLETO']), fecha(), 'super') for _ in range(n_productos // 50)))
+    cargar(A, 'login_logs', ['usuario', 'fecha', 'ip_address', 'device_info'], ((random.choice(USUARIOS)[0], fecha(), f"10.0.{random.randint(0, 255)}.{random.randint(1, 254)}", 'Mozilla/5.0 (Linux; Android 13) Tablet') for _ in range(max(50, n_trabajadores // 10))))
 
-    conn.commit()
-    conn.close()
-    print("✅ DB Actualizada a v2.0 (Usuarios y Trabajadores).")
+    A.ejecutar_sql("ANALYZE")  # estadísticas frescas para el planificador tras la carga masiva
+    A.reconstruir_resumen()  # contadores del dashboard y series coherentes con lo cargado
+    print(f"✅ DB poblada en {time.time() - t0:.1f} s")
 
 if __name__ == "__main__":
-    poblar_db()
\ No newline at end of file
+    ap = argparse.ArgumentParser(description="Pobla la base (SQLite local o DATABASE_URL) con datos sintéticos usando el esquema de app.py. "
+                                             "Ej. volumen productivo: --productos 100000 --trabajadores 20000 --prestamos 10000000")
+    ap.add_argument('--productos', type=int, default=200)
+    ap.add_argument('--trabajadores', type=int, default=3)
+    ap.add_argument('--prestamos', type=int, default=0)
+    ap.add_argument('--dias', type=int, default=365, help="historia hacia atrás desde hoy")
+    ap.add_argument('--semilla', type=int, default=None, help="para repetir exactamente los mismos datos")
+    a = ap.parse_args()
+    poblar_db(a.productos, a.trabajadores, a.prestamos, a.dias, a.semilla)